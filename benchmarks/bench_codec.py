@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# 编解码微基准：对比原始 json + str.format 路径与 JSONCodec 的单条消息 CPU 开销
+#
+# 在 Moonraker 的虚拟环境中运行（需要 tornado，可选 orjson/ujson）:
+#   ~/moonraker-env/bin/python benchmarks/bench_codec.py --printers 50
+#
+
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from mqtt_listener import JSONCodec, MQTTConfig  # noqa: E402
+
+INSTANCE_NAME = "3f2b8c1d9e7a4b6c8d0e1f2a3b4c5d6e"
+
+# 与 status_objects 配置一致的一帧 printer.objects.query 响应
+STATUS_FRAME = json.dumps({
+    "jsonrpc": "2.0",
+    "id": 1718000000.123,
+    "result": {
+        "eventtime": 12345.678,
+        "status": {
+            "webhooks": {"state": "ready", "state_message": "Printer is ready"},
+            "virtual_sdcard": {"progress": 0.4213, "is_active": True, "file_position": 10485760},
+            "idle_timeout": {"state": "Printing"},
+            "toolhead": {"position": [120.5, 98.2, 12.4, 3021.7], "print_time": 4211.2, "homed_axes": "xyz"},
+            "print_stats": {
+                "filename": "benchy-@-6f1c2a-@-a1b2c3.gcode",
+                "total_duration": 4300.1,
+                "print_duration": 4211.2,
+                "filament_used": 3021.7,
+                "state": "printing",
+                "message": "",
+                "info": {"total_layer": 240, "current_layer": 62}
+            },
+            "display_status": {"progress": 0.42},
+            "extruder": {"temperature": 214.9, "target": 215.0, "power": 0.43},
+            "heater_bed": {"temperature": 59.8, "target": 60.0, "power": 0.21},
+            "fan": {"speed": 1.0, "rpm": 7200}
+        }
+    }
+})
+
+
+def baseline_message(frame: str) -> str:
+    """原始实现：json.loads、重建信封、str.format 主题、json.dumps"""
+    status = json.loads(frame)['result']['status']
+    payload = {
+        "method": "printer.status",
+        "printerUUID": INSTANCE_NAME,
+        "params": {
+            "state": status.get('webhooks', {}).get('state', 'unknown'),
+            "message": status.get('webhooks', {}).get('state_message', ''),
+            "print_stats": status.get('print_stats', {}),
+        }
+    }
+    topic = MQTTConfig.TOPICS['response'].format(instance_name=INSTANCE_NAME)
+    return topic + json.dumps(payload, ensure_ascii=False)
+
+
+def codec_message(codec: JSONCodec, frame: str) -> str:
+    """新实现：快速解码、缓存主题、预序列化信封前缀"""
+    status = codec.loads(frame)['result']['status']
+    params = {
+        "state": status.get('webhooks', {}).get('state', 'unknown'),
+        "message": status.get('webhooks', {}).get('state_message', ''),
+        "print_stats": status.get('print_stats', {}),
+    }
+    topic = codec.render_topic(MQTTConfig.TOPICS['response'])
+    return topic + codec.encode_envelope(MQTTConfig.METHODS['printer_status'], params)
+
+
+def measure(func, iterations: int) -> float:
+    """返回单条消息的平均 CPU 时间（微秒）"""
+    start = time.process_time()
+    for _ in range(iterations):
+        func()
+    return (time.process_time() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONCodec 微基准")
+    parser.add_argument('--iterations', type=int, default=50000)
+    parser.add_argument('--printers', type=int, default=50, help="单台主机上的打印机数量")
+    parser.add_argument('--status-interval', type=float, default=1.0, help="状态轮询间隔（秒）")
+    args = parser.parse_args()
+
+    codec = JSONCodec(INSTANCE_NAME)
+    # 预热缓存
+    codec_message(codec, STATUS_FRAME)
+
+    baseline_us = measure(lambda: baseline_message(STATUS_FRAME), args.iterations)
+    codec_us = measure(lambda: codec_message(codec, STATUS_FRAME), args.iterations)
+    saved_us = baseline_us - codec_us
+    messages_per_hour = args.printers * 3600 / args.status_interval
+
+    print(f"codec backend:        {codec.name}")
+    print(f"baseline per message: {baseline_us:8.2f} us")
+    print(f"codec per message:    {codec_us:8.2f} us")
+    print(f"saved per message:    {saved_us:8.2f} us ({saved_us / baseline_us * 100:.1f}%)")
+    print(f"fleet host ({args.printers} printers @ {args.status_interval}s): "
+          f"{saved_us * messages_per_hour / 1e6:.2f} CPU-seconds saved per hour")
+
+
+if __name__ == "__main__":
+    main()
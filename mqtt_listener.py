@@ -4,12 +4,42 @@ import json
 import time
 import asyncio
 import urllib.request
+import urllib.parse
 import logging
 from tornado.websocket import websocket_connect
-from typing import Optional, Dict, Any, Callable
+from typing import Optional, Dict, Any, Callable, Tuple
 import random
 import string
 import os
+import re
+import heapq
+import hashlib
+import threading
+import shutil
+import sys
+import math
+import bisect
+import struct
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pathlib
+import itertools
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 class MQTTConfig:
     """MQTT 配置类"""
@@ -31,8 +61,1034 @@ class MQTTConfig:
         'print_progress': "print.progress", 
         'print_status': "print.status", 
         'printer_status': "printer.status",        
+        'transfer_status': "transfer.status",
+        'files_list': "files.list",
+        'files_delete': "files.delete",
+        'files_prefetch': "files.prefetch",
+        'files_usage': "files.usage",
+        'print_pause': "print.pause",
+        'print_resume': "print.resume",
+        'print_cancel': "print.cancel",
+        'emergency_stop': "printer.emergency_stop",
+        'gcode_script': "printer.gcode.script",
+        'timelapse_get': "timelapse.get",
+        'timelapse_ready': "timelapse.ready",
+        'timelapse_chunk': "timelapse.chunk",
+    }
+
+    # 打印控制方法对应的 Moonraker 接口
+    CONTROL_ENDPOINTS = {
+        'print_pause': "/printer/print/pause",
+        'print_resume': "/printer/print/resume",
+        'print_cancel': "/printer/print/cancel",
+        'emergency_stop': "/printer/emergency_stop",
+    }
+
+    # 未在 c3p-mqtt.cfg 中找到 status_objects 时使用的默认对象
+    DEFAULT_STATUS_OBJECTS = {
+        'webhooks': ['state', 'state_message'],
+        'virtual_sdcard': ['progress', 'is_active'],
+        'idle_timeout': ['state'],
+        'toolhead': ['position', 'print_time', 'homed_axes'],
+        'print_stats': None,
+        'display_status': ['progress'],
+        'extruder': ['temperature', 'target', 'power'],
+        'heater_bed': ['temperature', 'target', 'power'],
+        'fan': ['speed', 'rpm'],
     }
 
+    # 未声明字段的对象使用的字段列表
+    STATUS_OBJECT_FIELDS = {
+        'print_stats': ['filename', 'total_duration', 'print_duration', 'filament_used',
+                        'state', 'message', 'info'],
+        'webhooks': ['state', 'state_message'],
+        'virtual_sdcard': ['file_path', 'progress', 'is_active', 'file_position', 'file_size'],
+        'idle_timeout': ['state', 'printing_time'],
+        'display_status': ['progress', 'message'],
+        'fan': ['speed', 'rpm'],
+    }
+
+    # 监听器自身依赖的字段
+    REQUIRED_STATUS_FIELDS = {
+        'webhooks': ['state', 'state_message'],
+        'print_stats': ['state', 'filename'],
+        'virtual_sdcard': ['file_position'],
+    }
+
+    # 变化时立即发布、不受发布间隔限制的字段
+    URGENT_STATUS_FIELDS = (('webhooks', 'state'), ('print_stats', 'state'))
+
+    # 由层索引计算的进度，作为虚拟对象记录在状态模型中
+    PROGRESS_FIELDS = ['current_layer', 'total_layers', 'progress', 'eta']
+
+    # 调度优先级，数值越小越先执行
+    PRIORITY_CONTROL = 0
+    PRIORITY_SNAPSHOT = 10
+    PRIORITY_BULK = 50
+
+    # 调度配置: 方法 -> (优先级, 最大并发数, 最大排队数, 过期时间秒)
+    DISPATCH = {
+        'webcam_snapshot': (PRIORITY_SNAPSHOT, 2, 4, 10),
+        'print_new': (PRIORITY_BULK, 1, 4, 600),
+        'transfer_status': (PRIORITY_CONTROL, 2, 4, 10),
+        'files_list': (PRIORITY_SNAPSHOT, 2, 8, 30),
+        'files_delete': (PRIORITY_SNAPSHOT, 1, 4, 60),
+        'files_usage': (PRIORITY_SNAPSHOT, 2, 8, 30),
+        'files_prefetch': (PRIORITY_BULK, 1, 2, 3600),
+        'print_pause': (PRIORITY_CONTROL, 1, 4, 10),
+        'print_resume': (PRIORITY_CONTROL, 1, 4, 10),
+        'print_cancel': (PRIORITY_CONTROL, 1, 4, 10),
+        'gcode_script': (PRIORITY_CONTROL, 1, 16, 30),
+        'timelapse_get': (PRIORITY_BULK, 1, 2, 600),
+    }
+    # 控制类命令不受此上限约束
+    MAX_RUNNING_COMMANDS = 8
+
+    # 急停请求的超时时间（秒），其他控制请求使用 control_timeout 配置
+    EMERGENCY_STOP_TIMEOUT = 5
+
+class HandlerSpec:
+    """消息处理器注册信息"""
+    def __init__(self, handler: Optional[Callable], priority: int = MQTTConfig.PRIORITY_BULK,
+                 max_concurrency: int = 1, max_queue: int = 8, deadline: float = 30):
+        self.handler = handler
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.deadline = deadline
+
+class CommandDispatcher:
+    """按优先级调度 MQTT 命令，支持按方法限制并发、排队上限和过期丢弃"""
+    def __init__(self, logger, on_rejected: Callable, max_running: int = 8):
+        self.logger = logger
+        self.on_rejected = on_rejected
+        self.max_running = max_running
+        self.registry: Dict[str, HandlerSpec] = {}
+        self.pending = []
+        self.sequence = itertools.count()
+        self.queued: Dict[str, int] = {}
+        self.running: Dict[str, int] = {}
+        self.total_running = 0
+        self.tasks = set()
+
+    def register(self, method: str, handler: Optional[Callable], **kwargs):
+        """注册处理器，handler 为 None 表示静默忽略该方法"""
+        self.registry[method] = HandlerSpec(handler, **kwargs)
+
+    def get_handler(self, method: str) -> Optional[HandlerSpec]:
+        return self.registry.get(method)
+
+    def submit(self, method: str, data: Dict[str, Any]) -> bool:
+        """提交命令，队列已满时返回 False 并发送背压响应"""
+        spec = self.registry.get(method)
+        if spec is None:
+            self.logger.warning(f"未知的方法: {method}")
+            return False
+        if spec.handler is None:
+            return True
+
+        if self.queued.get(method, 0) >= spec.max_queue:
+            self.logger.warning(f"命令队列已满，拒绝: {method}")
+            self.on_rejected(method, data, 'busy')
+            return False
+
+        now = time.time()
+        deadline = now + spec.deadline
+        # 消息自带的截止时间（秒级时间戳）优先
+        try:
+            if data.get('deadline'):
+                deadline = min(deadline, float(data['deadline']))
+        except (TypeError, ValueError):
+            pass
+
+        heapq.heappush(self.pending, (spec.priority, next(self.sequence), method, deadline, data))
+        self.queued[method] = self.queued.get(method, 0) + 1
+        self._schedule()
+        return True
+
+    def _schedule(self):
+        """按优先级启动可执行的命令，丢弃已过期的命令"""
+        deferred = []
+        now = time.time()
+        while self.pending:
+            item = heapq.heappop(self.pending)
+            priority, _, method, deadline, data = item
+            spec = self.registry[method]
+            if self.total_running >= self.max_running and priority > MQTTConfig.PRIORITY_CONTROL:
+                # 队列按优先级排序，之后的命令同样无法启动
+                deferred.append(item)
+                break
+            if deadline < now:
+                self.queued[method] -= 1
+                self.logger.warning(f"命令已过期，丢弃: {method}")
+                self.on_rejected(method, data, 'expired')
+                continue
+            if self.running.get(method, 0) >= spec.max_concurrency:
+                deferred.append(item)
+                continue
+            self.queued[method] -= 1
+            self.running[method] = self.running.get(method, 0) + 1
+            self.total_running += 1
+            task = asyncio.create_task(self._run(spec, method, data))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        for item in deferred:
+            heapq.heappush(self.pending, item)
+
+    async def _run(self, spec: HandlerSpec, method: str, data: Dict[str, Any]):
+        try:
+            await spec.handler(data)
+            self.logger.info(f"处理完成: {method}")
+        except Exception as e:
+            self.logger.error(f"处理消息时出错: {str(e)}")
+        finally:
+            self.running[method] -= 1
+            self.total_running -= 1
+            self._schedule()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "running": dict(self.running),
+            "queued": dict(self.queued),
+            "total_running": self.total_running
+        }
+
+    def cancel_all(self):
+        for task in list(self.tasks):
+            task.cancel()
+        self.pending.clear()
+        self.queued.clear()
+
+MANAGED_FILE_SEPARATOR = '-@-'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def parse_managed_file_name(filename: str) -> Optional[Tuple[str, str, str]]:
+    """解析 <文件名>-@-<任务>-@-<fileKey>.gcode 格式的文件名"""
+    if not filename.endswith('.gcode'):
+        return None
+    parts = filename[:-len('.gcode')].split(MANAGED_FILE_SEPARATOR)
+    if len(parts) != 3:
+        return None
+    return parts[0], parts[1], parts[2]
+
+def compute_file_hash(path: pathlib.Path, algorithm: str = 'sha256') -> str:
+    """分块计算本地文件的哈希值"""
+    hasher = hashlib.new(algorithm)
+    with path.open('rb') as source_file:
+        while True:
+            chunk = source_file.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def parse_etag(headers) -> str:
+    """取出 ETag 中的哈希值"""
+    return (headers.get('etag') or '').replace('W/', '').strip('"').lower()
+
+def resolve_expected_hash(expected_hash: Optional[str], etag: str) -> Tuple[Optional[str], bool]:
+    """确定要校验的 SHA-256，返回 (SHA-256, 是否需要按 ETag 校验 MD5)"""
+    if not expected_hash and re.fullmatch(r'[0-9a-f]{64}', etag):
+        expected_hash = etag
+    use_md5 = not expected_hash and re.fullmatch(r'[0-9a-f]{32}', etag) is not None
+    return expected_hash, use_md5
+
+def verify_download(total_size: int, downloaded_size: int, file_hash: str,
+                    expected_hash: Optional[str], md5_hash: Optional[str], etag: str):
+    """校验完整性，校验失败的文件不会被上传和打印"""
+    if total_size and downloaded_size != total_size:
+        raise ValueError(f"文件下载不完整: {downloaded_size}/{total_size}")
+    if expected_hash and file_hash != expected_hash:
+        raise ValueError(f"文件 SHA-256 校验失败: {file_hash}")
+    if md5_hash and md5_hash != etag:
+        raise ValueError(f"文件 ETag 校验失败: {md5_hash}")
+
+def build_multipart_head(new_name: str, start_print: bool) -> Tuple[bytes, bytes, str]:
+    """构建上传到 Moonraker 的 multipart 头尾，返回 (头部, 尾部, Content-Type)"""
+    boundary = '----WebKitFormBoundary' + ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(16))
+    
+    content_type = f'multipart/form-data; boundary={boundary}'
+    
+    # 构建 multipart form-data
+    body = []
+    # 添加表单字段
+    body.append(f'--{boundary}'.encode())
+    body.append(b'Content-Disposition: form-data; name="path"')
+    body.append(b'')
+    body.append(b'')
+    
+    body.append(f'--{boundary}'.encode())
+    body.append(b'Content-Disposition: form-data; name="filename"')
+    body.append(b'')
+    body.append(new_name.encode())
+    
+    body.append(f'--{boundary}'.encode())
+    body.append(b'Content-Disposition: form-data; name="print"')
+    body.append(b'')
+    body.append(b'true' if start_print else b'false')
+    
+    # 添加文件内容
+    body.append(f'--{boundary}'.encode())
+    body.append(f'Content-Disposition: form-data; name="file"; filename="{new_name}"'.encode())
+    body.append(b'Content-Type: application/octet-stream')
+    body.append(b'')
+    body.append(b'')
+    
+    head = b'\r\n'.join(body)
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    return head, tail, content_type
+
+SNAPSHOT_TIMEOUT = 10
+
+def save_snapshot(url: str, path: pathlib.Path) -> int:
+    """获取摄像头快照并写入文件，返回字节数"""
+    with urllib.request.urlopen(url, timeout=SNAPSHOT_TIMEOUT) as response:
+        image = response.read()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(image)
+    return len(image)
+
+CONTACT_SHEET_FRAMES = 16
+CONTACT_SHEET_COLUMNS = 4
+CONTACT_SHEET_TILE = 320
+
+def build_contact_sheet(frames: list, output: pathlib.Path):
+    """从帧中均匀抽取缩略图拼成一张 JPEG，缺少 Pillow 时使用最后一帧"""
+    temp_path = output.with_suffix('.part')
+    if Image is None:
+        shutil.copyfile(frames[-1], temp_path)
+    else:
+        count = min(len(frames), CONTACT_SHEET_FRAMES)
+        step = (len(frames) - 1) / (count - 1) if count > 1 else 0
+        tiles = []
+        for i in range(count):
+            with Image.open(frames[round(i * step)]) as image:
+                tile = image.convert('RGB')
+            tile.thumbnail((CONTACT_SHEET_TILE, CONTACT_SHEET_TILE))
+            tiles.append(tile)
+        columns = min(count, CONTACT_SHEET_COLUMNS)
+        rows = math.ceil(count / columns)
+        width = max(tile.width for tile in tiles)
+        height = max(tile.height for tile in tiles)
+        sheet = Image.new('RGB', (columns * width, rows * height))
+        for i, tile in enumerate(tiles):
+            sheet.paste(tile, ((i % columns) * width, (i // columns) * height))
+        sheet.save(temp_path, format='JPEG', quality=85)
+    os.replace(temp_path, output)
+
+class GcodeMetadataParser:
+    """在下载过程中增量解析 gcode 切片信息和缩略图"""
+    # 头部逐行解析的字节数，之后只保留尾部用于解析切片配置
+    HEAD_LIMIT = 1024 * 1024
+    TAIL_LIMIT = 256 * 1024
+    LAYER_MARKERS = (b'\n;LAYER_CHANGE', b'\n;LAYER:')
+
+    SLICER_PATTERN = re.compile(r'^;\s*generated (?:by|with) ([^\s]+)(?:\s+(\S+))?', re.IGNORECASE)
+    THUMBNAIL_BEGIN = re.compile(r'^;\s*thumbnail(?:_(\w+))? begin (\d+)x(\d+) (\d+)')
+    THUMBNAIL_END = re.compile(r'^;\s*thumbnail(?:_\w+)? end')
+    FIELD_PATTERNS = (
+        ('estimated_time', re.compile(r'^;TIME:(\d+(?:\.\d+)?)'), float),
+        ('estimated_time', re.compile(r'^;\s*estimated printing time(?: \(normal mode\))?\s*=\s*(.+)'), 'duration'),
+        ('estimated_time', re.compile(r'^;.*total estimated time:\s*([\ddhms ]+)'), 'duration'),
+        ('filament_total', re.compile(r'^;Filament used:\s*([\d.]+)m'), 'meters'),
+        ('filament_total', re.compile(r'^;\s*filament used \[mm\]\s*=\s*([\d.]+)'), float),
+        ('filament_weight_total', re.compile(r'^;\s*(?:total )?filament used \[g\]\s*=\s*([\d.]+)'), float),
+        ('filament_type', re.compile(r'^;\s*filament_type\s*=\s*(.+)'), str),
+        ('layer_count', re.compile(r'^;LAYER_COUNT:(\d+)'), int),
+        ('layer_count', re.compile(r'^;\s*total layers? (?:count|number)\s*[=:]\s*(\d+)'), int),
+        ('layer_height', re.compile(r'^;\s*layer_height\s*=\s*([\d.]+)'), float),
+        ('layer_height', re.compile(r'^;Layer height:\s*([\d.]+)'), float),
+        ('first_layer_height', re.compile(r'^;\s*(?:first_layer_height|initial_layer_print_height)\s*=\s*([\d.]+)'), float),
+        ('nozzle_diameter', re.compile(r'^;\s*nozzle_diameter\s*=\s*([\d.]+)'), float),
+    )
+    DURATION_PATTERN = re.compile(r'(\d+)\s*([dhms])')
+
+    def __init__(self):
+        self.metadata: Dict[str, Any] = {}
+        self.thumbnails = []
+        self.bytes_seen = 0
+        self.line_parsing = True
+        self.partial = b''
+        self.tail = bytearray()
+        self.carry = b'\n'
+        self.layer_markers = 0
+        self.thumbnail = None
+
+    def feed(self, chunk: bytes):
+        """处理一个下载分块"""
+        self.bytes_seen += len(chunk)
+        self._count_layers(chunk)
+        if self.line_parsing:
+            data = self.partial + chunk
+            lines = data.split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self._parse_line(line)
+            if self.bytes_seen >= self.HEAD_LIMIT and self.thumbnail is None:
+                self.line_parsing = False
+                self.tail.extend(self.partial)
+                self.partial = b''
+        else:
+            self.tail.extend(chunk)
+            if len(self.tail) > self.TAIL_LIMIT * 2:
+                del self.tail[:-self.TAIL_LIMIT]
+
+    def _count_layers(self, chunk: bytes):
+        # 保留上一个分块的末尾，避免标记被分块截断；
+        # 完全落在保留部分中的标记已在上一个分块计数，需要扣除
+        data = self.carry + chunk
+        for marker in self.LAYER_MARKERS:
+            self.layer_markers += data.count(marker) - self.carry.count(marker)
+        self.carry = data[-(max(len(m) for m in self.LAYER_MARKERS) - 1):]
+
+    def _parse_line(self, raw: bytes):
+        line = raw.decode('utf-8', errors='ignore').strip()
+        if not line.startswith(';'):
+            return
+        if self.thumbnail is not None:
+            if self.THUMBNAIL_END.match(line):
+                self._finish_thumbnail()
+            else:
+                self.thumbnail['data'].append(line[1:].strip())
+            return
+
+        match = self.THUMBNAIL_BEGIN.match(line)
+        if match:
+            self.thumbnail = {
+                'format': (match.group(1) or 'PNG').lower(),
+                'width': int(match.group(2)),
+                'height': int(match.group(3)),
+                'size': int(match.group(4)),
+                'data': []
+            }
+            return
+
+        if 'slicer' not in self.metadata:
+            match = self.SLICER_PATTERN.match(line)
+            if match:
+                self.metadata['slicer'] = match.group(1)
+                if match.group(2):
+                    self.metadata['slicer_version'] = match.group(2)
+                return
+
+        for key, pattern, convert in self.FIELD_PATTERNS:
+            if key in self.metadata:
+                continue
+            match = pattern.match(line)
+            if match:
+                value = self._convert(match.group(1).strip(), convert)
+                if value is not None:
+                    self.metadata[key] = value
+                return
+
+    def _convert(self, value: str, convert):
+        try:
+            if convert == 'duration':
+                parts = self.DURATION_PATTERN.findall(value)
+                if not parts:
+                    return None
+                units = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+                return float(sum(int(num) * units[unit] for num, unit in parts))
+            if convert == 'meters':
+                return float(value) * 1000
+            return convert(value)
+        except ValueError:
+            return None
+
+    def _finish_thumbnail(self):
+        thumbnail = self.thumbnail
+        self.thumbnail = None
+        thumbnail['data'] = ''.join(thumbnail['data'])
+        self.thumbnails.append(thumbnail)
+
+    def finish(self) -> Dict[str, Any]:
+        """下载结束后解析尾部并返回元数据"""
+        if self.line_parsing:
+            self._parse_line(self.partial)
+            self.partial = b''
+        else:
+            tail = bytes(self.tail[-self.TAIL_LIMIT:])
+            lines = tail.split(b'\n')
+            # 第一行可能不完整
+            for line in lines[1:]:
+                self._parse_line(line)
+        self.tail = bytearray()
+
+        metadata = dict(self.metadata)
+        if 'layer_count' not in metadata and self.layer_markers:
+            metadata['layer_count'] = self.layer_markers
+        metadata['size'] = self.bytes_seen
+        if self.thumbnails:
+            metadata['thumbnails'] = [
+                {key: thumb[key] for key in ('format', 'width', 'height', 'size')}
+                for thumb in self.thumbnails
+            ]
+            smallest = min(self.thumbnails, key=lambda thumb: thumb['width'] * thumb['height'])
+            metadata['thumbnail'] = smallest
+        return metadata
+
+class TokenBucket:
+    """线程安全的令牌桶，rate 为 0 表示不限速"""
+    USAGE_WINDOW = 5
+
+    def __init__(self, rate: float = 0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.total_bytes = 0
+        self.window_start = self.last_refill
+        self.window_bytes = 0
+        self.usage = 0.0
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def reserve(self, size: int) -> float:
+        """消耗令牌，返回需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self._account(now, size)
+            if self.rate <= 0:
+                self.last_refill = now
+                return 0
+            # 突发上限为一秒的流量
+            self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= size
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def record(self, size: int):
+        """只记录使用量，不消耗令牌（用于由传输子进程限速的流量）"""
+        with self.lock:
+            self._account(time.monotonic(), size)
+
+    def _account(self, now: float, size: int):
+        self.total_bytes += size
+        self.window_bytes += size
+        if now - self.window_start >= self.USAGE_WINDOW:
+            self.usage = self.window_bytes / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+
+    def get_usage(self) -> float:
+        with self.lock:
+            elapsed = time.monotonic() - self.window_start
+            if elapsed >= self.USAGE_WINDOW:
+                return self.window_bytes / elapsed
+            return self.usage
+
+class TransferGovernor:
+    """根据打印状态限制后台传输的下载带宽和磁盘写入速率"""
+    IDLE_STATE = 'idle'
+    THROTTLED_STATES = ('printing', 'paused')
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]]):
+        # limits: 状态 -> (下载字节/秒, 写入字节/秒)，0 表示不限速
+        self.limits = limits
+        self.download = TokenBucket()
+        self.disk_write = TokenBucket()
+        self.listeners = []
+        self.state = None
+        self.set_state(self.IDLE_STATE)
+
+    @classmethod
+    def from_config(cls, config) -> TransferGovernor:
+        """从 [mqtt_listener] 配置段读取各状态的限速（KB/s）"""
+        limits = {}
+        defaults = {
+            cls.IDLE_STATE: (0, 0),
+            'printing': (512, 1024),
+            'paused': (2048, 4096),
+        }
+        for state, (download, disk_write) in defaults.items():
+            limits[state] = (
+                config.getfloat(f'download_limit_{state}', download) * 1024,
+                config.getfloat(f'disk_write_limit_{state}', disk_write) * 1024
+            )
+        return cls(limits)
+
+    def set_state(self, state: str):
+        """根据 print_stats.state 切换限速"""
+        if state not in self.THROTTLED_STATES:
+            state = self.IDLE_STATE
+        if state == self.state:
+            return
+        self.state = state
+        download, disk_write = self.limits.get(state, (0, 0))
+        self.download.set_rate(download)
+        self.disk_write.set_rate(disk_write)
+        for listener in self.listeners:
+            listener(download, disk_write)
+
+    def add_listener(self, listener: Callable):
+        """注册限速变化回调，注册时立即同步当前限速"""
+        self.listeners.append(listener)
+        listener(self.download.rate, self.disk_write.rate)
+
+    async def throttle_download(self, size: int):
+        wait = self.download.reserve(size)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def throttle_disk_write(self, size: int):
+        """在执行器线程中调用，会阻塞当前线程"""
+        wait = self.disk_write.reserve(size)
+        if wait > 0:
+            time.sleep(wait)
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "download": {
+                "limit": self.download.rate,
+                "usage": round(self.download.get_usage()),
+                "total": self.download.total_bytes
+            },
+            "disk_write": {
+                "limit": self.disk_write.rate,
+                "usage": round(self.disk_write.get_usage()),
+                "total": self.disk_write.total_bytes
+            },
+            "limits": {
+                state: {"download": download, "disk_write": disk_write}
+                for state, (download, disk_write) in self.limits.items()
+            }
+        }
+
+class LayerIndex:
+    """层变化字节偏移与累计预计时间的紧凑索引，支持按文件位置 O(log n) 查询"""
+    HEADER = struct.Struct('<4sIQd')
+    MAGIC = b'C3PL'
+
+    def __init__(self, offsets: array, times: array, total_time: float, file_size: int):
+        self.offsets = offsets
+        self.times = times
+        self.total_time = total_time
+        self.file_size = file_size
+
+    def lookup(self, position: int) -> Dict[str, Any]:
+        """根据 virtual_sdcard.file_position 计算当前层、进度和剩余时间"""
+        count = len(self.offsets)
+        index = bisect.bisect_right(self.offsets, position) - 1
+        if index < 0:
+            start_offset, start_time = 0, 0.0
+            end_offset = self.offsets[0] if count else self.file_size
+            end_time = self.times[0] if count else self.total_time
+        else:
+            start_offset, start_time = self.offsets[index], self.times[index]
+            if index + 1 < count:
+                end_offset, end_time = self.offsets[index + 1], self.times[index + 1]
+            else:
+                end_offset, end_time = self.file_size, self.total_time
+
+        # 在层内按字节位置线性插值
+        fraction = 0.0
+        if end_offset > start_offset:
+            fraction = min(1.0, max(0.0, (position - start_offset) / (end_offset - start_offset)))
+        result = {
+            "current_layer": max(0, index + 1),
+            "total_layers": count,
+        }
+        if self.total_time > 0:
+            elapsed = start_time + fraction * (end_time - start_time)
+            result["progress"] = round(elapsed / self.total_time * 100, 1)
+            result["eta"] = int(round(max(0.0, self.total_time - elapsed), -1))
+        else:
+            # 没有时间信息时按字节位置估算进度，不提供剩余时间
+            progress = position / self.file_size * 100 if self.file_size else 0.0
+            result["progress"] = round(min(100.0, max(0.0, progress)), 1)
+            result["eta"] = None
+        return result
+
+    def save(self, path: pathlib.Path):
+        offsets, times = array('Q', self.offsets), array('d', self.times)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+            times.byteswap()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix('.tmp')
+        with temp_path.open('wb') as index_file:
+            index_file.write(self.HEADER.pack(self.MAGIC, len(offsets), self.file_size, self.total_time))
+            index_file.write(offsets.tobytes())
+            index_file.write(times.tobytes())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> Optional[LayerIndex]:
+        try:
+            with path.open('rb') as index_file:
+                magic, count, file_size, total_time = cls.HEADER.unpack(index_file.read(cls.HEADER.size))
+                if magic != cls.MAGIC:
+                    return None
+                offsets, times = array('Q'), array('d')
+                offsets.fromfile(index_file, count)
+                times.fromfile(index_file, count)
+        except (OSError, EOFError, struct.error):
+            return None
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+            times.byteswap()
+        return cls(offsets, times, total_time, file_size)
+
+class LayerIndexBuilder:
+    """在数据流中记录层变化位置和切片软件给出的时间标记"""
+    # 匹配以换行开头的整行，扫描只在完整行范围内进行
+    PATTERN = re.compile(rb'\n(?:;LAYER_CHANGE|;LAYER:-?\d+|;TIME_ELAPSED:([\d.]+)|M73 [^\n]*?R(\d+))')
+
+    def __init__(self):
+        self.offsets = array('Q')
+        self.raw_times = array('d')
+        self.carry = b'\n'
+        self.carry_offset = -1
+        self.size = 0
+        self.time_mode = None
+        self.last_time = math.nan
+
+    def feed(self, chunk: bytes):
+        self.size += len(chunk)
+        data = self.carry + chunk
+        base = self.carry_offset
+        end = data.rfind(b'\n')
+        for match in self.PATTERN.finditer(data, 0, end):
+            elapsed, remaining = match.group(1), match.group(2)
+            if elapsed is not None:
+                self.time_mode = 'elapsed'
+                self.last_time = float(elapsed)
+            elif remaining is not None:
+                if self.time_mode != 'elapsed':
+                    self.time_mode = 'remaining'
+                    self.last_time = float(remaining) * 60
+            else:
+                self.offsets.append(base + match.start() + 1)
+                self.raw_times.append(self.last_time)
+        self.carry = data[end:]
+        self.carry_offset = base + end
+
+    def finish(self, estimated_time: Optional[float] = None) -> LayerIndex:
+        """生成索引，没有时间标记时按字节比例估算"""
+        times = array('d')
+        if self.time_mode == 'remaining':
+            # M73 R 为剩余分钟数，换算成已用时间
+            total = estimated_time or max((t for t in self.raw_times if not math.isnan(t)), default=0.0)
+            for value in self.raw_times:
+                times.append(0.0 if math.isnan(value) else max(0.0, total - value))
+        elif self.time_mode == 'elapsed':
+            total = estimated_time or (self.raw_times[-1] if self.raw_times else 0.0)
+            for value in self.raw_times:
+                times.append(0.0 if math.isnan(value) else value)
+        else:
+            total = estimated_time or 0.0
+            for offset in self.offsets:
+                times.append(total * offset / self.size if self.size else 0.0)
+        return LayerIndex(self.offsets, times, float(total), self.size)
+
+class TimelapseSession:
+    """一次打印的延时摄影，帧保存在按总大小限制的磁盘环形缓冲中"""
+    FRAME_PATTERN = 'frame_%06d.jpg'
+    # 这些状态结束时合成，error 等状态直接丢弃
+    RENDER_STATES = ('complete', 'cancelled')
+
+    def __init__(self, session_id: str, job_uuid: str, path: pathlib.Path, max_bytes: int,
+                 mode: str, interval: float):
+        self.session_id = session_id
+        self.job_uuid = job_uuid
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.interval = interval
+        self.frames = deque()   # (序号, 字节数)
+        self.total_bytes = 0
+        self.next_seq = 0
+        self.last_layer = None
+        self.last_capture = 0.0
+        self.capture_task = None
+
+    def should_capture(self, layer: Optional[int], now: float) -> bool:
+        """按层模式在层变化时取帧，没有层信息或按时间模式时按间隔取帧"""
+        if self.capture_task and not self.capture_task.done():
+            return False
+        if self.mode == 'layer' and layer is not None:
+            return layer != self.last_layer
+        return now - self.last_capture >= self.interval
+
+    def mark(self, layer: Optional[int], now: float):
+        self.last_layer = layer
+        self.last_capture = now
+
+    def next_path(self) -> pathlib.Path:
+        return self.path.joinpath(self.FRAME_PATTERN % self.next_seq)
+
+    def commit(self, size: int):
+        """记录新写入的帧，超出上限时删除最旧的帧"""
+        self.frames.append((self.next_seq, size))
+        self.next_seq += 1
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and len(self.frames) > 1:
+            seq, frame_size = self.frames.popleft()
+            try:
+                self.path.joinpath(self.FRAME_PATTERN % seq).unlink()
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= frame_size
+
+    def get_first_seq(self) -> int:
+        return self.frames[0][0]
+
+    def get_frame_paths(self) -> list:
+        return [self.path.joinpath(self.FRAME_PATTERN % seq) for seq, _ in self.frames]
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class StatusModel:
+    """根据 status_objects 生成的定长状态记录
+
+    所有字段在初始化时分配固定槽位，更新时原地写入并记录脏位，
+    变化检测只与本次收到的字段数量有关，不再保留整份旧状态做深比较。
+    """
+    WHOLE_OBJECT = '*'
+
+    def __init__(self, objects: Dict[str, Optional[list]], urgent_fields=()):
+        self.index: Dict[str, Dict[str, int]] = {}
+        self.slots = []
+        for obj, fields in objects.items():
+            field_index = self.index.setdefault(obj, {})
+            for field in (fields or [self.WHOLE_OBJECT]):
+                if field not in field_index:
+                    field_index[field] = len(self.slots)
+                    self.slots.append((obj, field))
+        self.values = [None] * len(self.slots)
+        self.dirty = 0
+        self.version = 0
+        self.urgent_mask = 0
+        for obj, field in urgent_fields:
+            slot = self.index.get(obj, {}).get(field)
+            if slot is not None:
+                self.urgent_mask |= 1 << slot
+
+    def get_query_objects(self) -> Dict[str, Optional[list]]:
+        """生成 printer.objects.subscribe/query 使用的对象列表"""
+        return {
+            obj: None if self.WHOLE_OBJECT in fields else list(fields)
+            for obj, fields in self.index.items()
+        }
+
+    def update(self, status: Dict[str, Any]) -> int:
+        """原地更新字段，返回发生变化的字段数量"""
+        changed = 0
+        values = self.values
+        for obj, fields in status.items():
+            field_index = self.index.get(obj)
+            if field_index is None or not isinstance(fields, dict):
+                continue
+            whole_slot = field_index.get(self.WHOLE_OBJECT)
+            if whole_slot is not None:
+                # 未声明字段的对象整体存放在一个槽位中
+                current = values[whole_slot]
+                if current is None:
+                    values[whole_slot] = current = {}
+                for field, value in fields.items():
+                    if current.get(field) != value:
+                        current[field] = value
+                        changed += 1
+                        self.dirty |= 1 << whole_slot
+                continue
+            for field, value in fields.items():
+                slot = field_index.get(field)
+                if slot is not None and values[slot] != value:
+                    values[slot] = value
+                    self.dirty |= 1 << slot
+                    changed += 1
+        if changed:
+            self.version += 1
+        return changed
+
+    def get(self, obj: str, field: str, default=None):
+        slot = self.index.get(obj, {}).get(field)
+        if slot is None or self.values[slot] is None:
+            return default
+        return self.values[slot]
+
+    def has_urgent_changes(self) -> bool:
+        return bool(self.dirty & self.urgent_mask)
+
+    def clear_dirty(self):
+        self.dirty = 0
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        """生成发布用的嵌套字典，仅在需要发布时调用"""
+        result: Dict[str, Dict[str, Any]] = {}
+        for (obj, field), value in zip(self.slots, self.values):
+            if value is None:
+                continue
+            if field == self.WHOLE_OBJECT:
+                result.setdefault(obj, {}).update(value)
+            else:
+                result.setdefault(obj, {})[field] = value
+        return result
+
+class JSONCodec:
+    """JSON 编解码层，优先使用 orjson/ujson，未安装时回退到标准库
+
+    同时缓存渲染后的主题和消息信封前缀，避免每条消息重复格式化。
+    """
+    def __init__(self, instance_name: str):
+        self.instance_name = instance_name
+        self.topic_cache: Dict[str, str] = {}
+        self.envelope_cache: Dict[str, str] = {}
+        if orjson is not None:
+            self.name = 'orjson'
+        elif ujson is not None:
+            self.name = 'ujson'
+        else:
+            self.name = 'json'
+
+    def loads(self, data):
+        if orjson is not None:
+            return orjson.loads(data)
+        if ujson is not None:
+            return ujson.loads(data)
+        return json.loads(data)
+
+    def dumps(self, obj) -> str:
+        try:
+            if orjson is not None:
+                return orjson.dumps(obj).decode('utf-8')
+            if ujson is not None:
+                return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            # 快速编码器不支持的类型交给标准库处理
+            pass
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+    def render_topic(self, topic: str) -> str:
+        """渲染并缓存包含 {instance_name} 的主题"""
+        rendered = self.topic_cache.get(topic)
+        if rendered is None:
+            rendered = topic
+            if "{instance_name}" in topic:
+                rendered = topic.format(instance_name=self.instance_name)
+            self.topic_cache[topic] = rendered
+        return rendered
+
+    def encode_envelope(self, method: str, params: Any) -> str:
+        """使用预先序列化的信封前缀编码消息"""
+        prefix = self.envelope_cache.get(method)
+        if prefix is None:
+            prefix = (
+                '{"method":' + self.dumps(method)
+                + ',"printerUUID":' + self.dumps(self.instance_name)
+                + ',"params":'
+            )
+            self.envelope_cache[method] = prefix
+        return prefix + self.dumps(params) + '}'
+
+class TransferWorker:
+    """传输子进程客户端，负责启动进程、下发任务并分发进度事件"""
+    LINE_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.process = None
+        self.pending: Dict[int, Tuple[asyncio.Future, Optional[Callable]]] = {}
+        self.ids = itertools.count(1)
+        self.limits = None
+        self.start_lock = asyncio.Lock()
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def _ensure_started(self):
+        async with self.start_lock:
+            if self.is_running():
+                return
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), '--transfer-worker',
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                limit=self.LINE_LIMIT
+            )
+            asyncio.create_task(self._read_events(self.process))
+            self.logger.info(f"传输子进程已启动, pid: {self.process.pid}")
+            if self.limits:
+                self.set_limits(*self.limits)
+
+    def _send(self, message: Dict[str, Any]):
+        self.process.stdin.write((json.dumps(message) + '\n').encode('utf-8'))
+
+    def set_limits(self, download: float, disk_write: float):
+        """同步限速到子进程"""
+        self.limits = (download, disk_write)
+        if self.is_running():
+            self._send({'op': 'limits', 'download': download, 'disk_write': disk_write})
+
+    async def request(self, op: str, params: Dict[str, Any], on_progress: Optional[Callable] = None) -> Dict[str, Any]:
+        """发送任务并等待完成，进度事件通过 on_progress 回调"""
+        await self._ensure_started()
+        job_id = next(self.ids)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[job_id] = (future, on_progress)
+        try:
+            message = dict(params)
+            message.update(op=op, id=job_id)
+            self._send(message)
+            await self.process.stdin.drain()
+            return await future
+        except asyncio.CancelledError:
+            if self.is_running():
+                self._send({'op': 'cancel', 'target': job_id})
+            raise
+        finally:
+            self.pending.pop(job_id, None)
+
+    async def _read_events(self, process):
+        reason = "传输子进程已退出"
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                entry = self.pending.get(event.get('id'))
+                if entry is None:
+                    continue
+                future, on_progress = entry
+                kind = event.get('event')
+                if kind == 'progress':
+                    if on_progress:
+                        on_progress(event)
+                elif future.done():
+                    continue
+                elif kind == 'done':
+                    future.set_result(event.get('result') or {})
+                elif kind == 'error':
+                    future.set_exception(RuntimeError(event.get('message', '')))
+        except Exception as e:
+            # 输出超过 LINE_LIMIT 等读取错误后无法继续解析，结束子进程，下次请求时重新启动
+            reason = f"传输子进程输出异常: {str(e)}"
+            if process.returncode is None:
+                process.kill()
+
+        if self.process is process:
+            self.process = None
+        # 未完成的任务全部失败
+        for future, _ in list(self.pending.values()):
+            if not future.done():
+                future.set_exception(RuntimeError(reason))
+        self.logger.warning(reason)
+
+    def stop(self):
+        if self.is_running():
+            self.process.terminate()
+
 class MQTTListener:
     def __init__(self, config):
         self.server = config.get_server()
@@ -49,6 +1105,62 @@ class MQTTListener:
         }
         
         self.mqtt.moonraker_status_topic = f'server/will/{self.instance_name}'
+
+        # JSON 编解码
+        self.codec = JSONCodec(self.instance_name)
+
+        # 文件路径配置，元数据缓存保存在 gcodes/.c3p 目录
+        data_path = self.server.get_app_args().get('data_path', '~/printer_data')
+        self.gcodes_path = pathlib.Path(data_path).expanduser().joinpath('gcodes')
+        self.file_cache_path = self.gcodes_path.joinpath('.c3p')
+
+        # 打印控制使用独立线程池，避免被文件传输占满；急停不经过线程池
+        self.control_executor = ThreadPoolExecutor(max_workers=2)
+        self.control_timeout = config.getfloat('control_timeout', 120)
+        self.control_methods = {
+            MQTTConfig.METHODS[key]: endpoint for key, endpoint in MQTTConfig.CONTROL_ENDPOINTS.items()
+        }
+
+        # 后台传输限速
+        self.governor = TransferGovernor.from_config(config)
+        self.upload_chunk_size = 64 * 1024
+
+        # 可选的传输子进程，下载、哈希、解析和上传不占用 Moonraker 进程
+        self.transfer_worker = None
+        if config.getboolean('transfer_worker', False):
+            self.transfer_worker = TransferWorker(self.logger)
+            self.governor.add_listener(self.transfer_worker.set_limits)
+
+        # 文件管理与磁盘清理策略
+        self.max_page_size = 500
+        self.current_print_file = None
+        self.cleanup_min_free = config.getint('cleanup_min_free_mb', 1024) * 1024 * 1024
+        self.cleanup_target_free = max(
+            config.getint('cleanup_target_free_mb', 2048) * 1024 * 1024, self.cleanup_min_free)
+        self.cleanup_keep_hours = config.getfloat('cleanup_keep_hours', 24)
+        self.cleanup_interval = config.getint('cleanup_interval', 300)
+        self.last_cleanup_check = 0
+        self.cleanup_lock = asyncio.Lock()
+
+        # 延时摄影，帧和合成结果保存在 gcodes/.c3p/timelapse 目录
+        # 云端只能通过 MQTT 访问打印机，默认分块发送合成结果
+        self.timelapse_enabled = config.getboolean('timelapse', False)
+        self.timelapse_mode = config.get('timelapse_mode', 'layer')
+        if self.timelapse_mode not in ('layer', 'interval'):
+            self.logger.warning(f"未知的延时摄影模式: {self.timelapse_mode}，使用 layer")
+            self.timelapse_mode = 'layer'
+        self.timelapse_interval = config.getfloat('timelapse_interval', 30)
+        self.timelapse_max_bytes = config.getint('timelapse_max_mb', 200) * 1024 * 1024
+        self.timelapse_fps = config.getint('timelapse_fps', 25)
+        self.timelapse_keep = config.getint('timelapse_keep', 5)
+        self.timelapse_chunk_size = config.getint('timelapse_chunk_kb', 256) * 1024
+        self.timelapse_chunk_interval = config.getfloat('timelapse_chunk_interval', 0.1)
+        self.timelapse_path = self.file_cache_path.joinpath('timelapse')
+        self.timelapse_session = None
+
+        # 当前打印文件的层索引
+        self.layer_index = None
+        self.layer_index_file = None
         
         
         # Websocket 配置
@@ -59,7 +1171,21 @@ class MQTTListener:
         self.last_status_update = time.time()
         self.status_timeout = 5
         self.stop_status_check = None
+
+        # 状态模型，需在启动 WebSocket 连接前创建
+        self.status_model = StatusModel(self.load_status_objects(config), MQTTConfig.URGENT_STATUS_FIELDS)
+        self.status_min_interval = config.getfloat('status_min_interval', 1)
+        self.status_heartbeat = config.getfloat('status_heartbeat', 200)
+        self.last_status_publish = 0
         
+        # 命令调度器
+        self.dispatcher = CommandDispatcher(
+            self.logger,
+            self.send_dispatch_rejection,
+            max_running=MQTTConfig.MAX_RUNNING_COMMANDS
+        )
+        self.register_handlers()
+
         # 注册监听器
         self.register_listeners()
         
@@ -68,11 +1194,6 @@ class MQTTListener:
             asyncio.create_task(self.connect_websocket())
         except Exception as e:
             self.logger.error(f"Task creation failed: {e}")
-        
-        # 状态缓存
-        self.previous_status_data = None
-        self.same_status_count = 0
-        self.max_same_status_count = 100
 
     def setup_logging(self):
         """配置日志系统"""
@@ -101,6 +1222,32 @@ class MQTTListener:
         # 记录初始化消息
         self.logger.info("MQTT监听器已启动")
 
+    def load_status_objects(self, config) -> Dict[str, Optional[list]]:
+        """读取 [mqtt] status_objects 并补全监听器依赖的字段"""
+        objects = dict(MQTTConfig.DEFAULT_STATUS_OBJECTS)
+        try:
+            declared = config.getsection('mqtt').getdict('status_objects', None, allow_empty_fields=True)
+            if declared:
+                objects = {
+                    obj: [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+                    for obj, fields in declared.items()
+                }
+        except Exception as e:
+            self.logger.warning(f"读取 status_objects 失败，使用默认配置: {str(e)}")
+
+        result = {}
+        for obj, fields in objects.items():
+            if not fields:
+                fields = MQTTConfig.STATUS_OBJECT_FIELDS.get(obj)
+            result[obj] = list(fields) if fields else None
+        for obj, fields in MQTTConfig.REQUIRED_STATUS_FIELDS.items():
+            if obj not in result:
+                result[obj] = list(fields)
+            elif result[obj] is not None:
+                result[obj].extend(field for field in fields if field not in result[obj])
+        result['progress'] = list(MQTTConfig.PROGRESS_FIELDS)
+        return result
+
     async def _init_test_message(self):
         """延迟发送测试消息"""
         try:
@@ -113,44 +1260,87 @@ class MQTTListener:
 
     def register_listeners(self):
         """注册MQTT主题监听"""
-        topic = MQTTConfig.TOPICS['command'].format(instance_name=self.instance_name)
+        topic = self.codec.render_topic(MQTTConfig.TOPICS['command'])
         self.mqtt.subscribe_topic(topic, self._handle_message, qos=1)
         self.logger.info(f"已订阅MQTT主题: {topic}")
 
-    def get_message_handler(self, method_name: str) -> Optional[Callable]:
-        """获取消息处理器"""
+    def register_handlers(self):
+        """注册消息处理器及其调度配置"""
         handlers = {
-            MQTTConfig.METHODS['webcam_snapshot']: self.handle_webcam_snapshot,
-            MQTTConfig.METHODS['print_new']: self.handle_print_new,
-            MQTTConfig.METHODS['printer_status']: None  # 忽略状态消息
+            'webcam_snapshot': self.handle_webcam_snapshot,
+            'print_new': self.handle_print_new,
+            'transfer_status': self.handle_transfer_status,
+            'files_list': self.handle_files_list,
+            'files_delete': self.handle_files_delete,
+            'files_prefetch': self.handle_files_prefetch,
+            'files_usage': self.handle_files_usage,
+            'print_pause': self.handle_print_control,
+            'print_resume': self.handle_print_control,
+            'print_cancel': self.handle_print_control,
+            'gcode_script': self.handle_gcode_script,
+            'timelapse_get': self.handle_timelapse_get,
         }
-        return handlers.get(method_name)
+        for key, handler in handlers.items():
+            priority, max_concurrency, max_queue, deadline = MQTTConfig.DISPATCH[key]
+            self.dispatcher.register(
+                MQTTConfig.METHODS[key],
+                handler,
+                priority=priority,
+                max_concurrency=max_concurrency,
+                max_queue=max_queue,
+                deadline=deadline
+            )
+        # 忽略状态消息
+        self.dispatcher.register(MQTTConfig.METHODS['printer_status'], None)
+
+    def get_message_handler(self, method_name: str) -> Optional[Callable]:
+        """获取消息处理器"""
+        spec = self.dispatcher.get_handler(method_name)
+        return spec.handler if spec else None
 
     async def _handle_message(self, payload):
         """处理MQTT消息"""
         try:
             if isinstance(payload, bytes):
                 payload = payload.decode('utf-8')
-            data = json.loads(payload)
+            data = self.codec.loads(payload)
             self.logger.info(f"收到消息: {data}")
             
             method = data.get('method', '')
-            handler = self.get_message_handler(method)
-            
-            if handler:
-                await handler(data)
-                self.logger.info(f"处理完成: {method}")
-            else:
-                self.logger.warning(f"未知的方法: {method}")
+            if method == MQTTConfig.METHODS['emergency_stop']:
+                # 急停不进入调度队列，立即在独立线程中发送
+                asyncio.create_task(self.handle_emergency_stop(data))
+                return
+            self.dispatcher.submit(method, data)
                 
-        except json.JSONDecodeError as e:
+        except ValueError as e:
             self.logger.error(f"JSON解码错误: {str(e)}")
             # self.send_error_message(f"无效的JSON格式: {str(e)}")
         except Exception as e:
             self.logger.error(f"处理消息时出错: {str(e)}")
             # self.send_error_message(str(e))
 
-    def handle_webcam_snapshot(self, payload: Dict[str, Any] = None):
+    def send_dispatch_rejection(self, method: str, data: Dict[str, Any], reason: str):
+        """发送背压/过期响应"""
+        params = data.get('params') or {}
+        messages = {
+            'busy': "命令队列已满，请稍后重试",
+            'expired': "命令已过期，未执行"
+        }
+        response_params = {
+            "status": reason,
+            "message": messages.get(reason, reason)
+        }
+        if isinstance(params, dict) and params.get('printjobuuid'):
+            response_params["job_uuid"] = params['printjobuuid']
+        self.publish_envelope(
+            MQTTConfig.TOPICS['response'],
+            method,
+            response_params,
+            qos=0
+        )
+
+    async def handle_webcam_snapshot(self, payload: Dict[str, Any] = None):
         """处理摄像头快照请求"""
         try:
             self.logger.info("开始获取摄像头快照")
@@ -159,8 +1349,14 @@ class MQTTListener:
             self.logger.info(f"请求URL: {snapshot_url}")
             
             snapshot_url_with_params = f"{snapshot_url}?timestamp={int(time.time())}"
-            response = urllib.request.urlopen(snapshot_url_with_params)
-            image_base64 = base64.b64encode(response.read()).decode('utf-8')
+            if self.transfer_worker:
+                result = await self.transfer_worker.request('snapshot', {'url': snapshot_url_with_params})
+                image_base64 = result['data']
+            else:
+                loop = asyncio.get_event_loop()
+                response = await loop.run_in_executor(None, urllib.request.urlopen, snapshot_url_with_params)
+                image = await loop.run_in_executor(None, response.read)
+                image_base64 = base64.b64encode(image).decode('utf-8')
             self.logger.info("成功获取并编码图片")
             
             self.send_snapshot_response("success", image_base64)
@@ -176,18 +1372,16 @@ class MQTTListener:
 
     def send_snapshot_response(self, status: str, value: Optional[str] = None):
         """发送摄像头快照响应"""
-        response_payload = {
-            "method": MQTTConfig.METHODS['webcam_snapshot'],
-            "params": {
-                "status": status,
-            }
+        params = {
+            "status": status,
         }
         if value:
-            response_payload["params"]["value"] = value
+            params["value"] = value
 
-        self.publish_message(
-            MQTTConfig.TOPICS['response'].format(**self.config),
-            response_payload,
+        self.publish_envelope(
+            MQTTConfig.TOPICS['response'],
+            MQTTConfig.METHODS['webcam_snapshot'],
+            params,
             qos=0
         )
         self.logger.info("已发送摄像头快照响应")
@@ -216,12 +1410,13 @@ class MQTTListener:
             self.logger.info(f"文件列表: {files}")
 
             # 查找匹配的文件
-            for file in files:
-                parts = file['filename'].split('-@-')
-                if len(parts) > 1 and parts[1] == file_key:
-                    new_name = f"{parts[0]}-@-{job_uuid}-@-{file_key}.gcode"
-                    self.logger.info(f"找到匹配文件: {file['filename']} -> {new_name}")
-                    return await self.handle_existing_file(file['filename'], new_name, job_uuid)
+            expected_hash = self._get_expected_hash(params)
+            match = await self.find_reusable_file(files, file_key, expected_hash)
+            if match:
+                base_name = parse_managed_file_name(match)[0]
+                new_name = f"{base_name}-@-{job_uuid}-@-{file_key}.gcode"
+                self.logger.info(f"找到匹配文件: {match} -> {new_name}")
+                return await self.handle_existing_file(match, new_name, job_uuid)
 
             # 未找到匹配文件，处理新文件
             self.logger.info("未找到匹配文件，开始下载新文件")
@@ -230,25 +1425,58 @@ class MQTTListener:
         except Exception as e:
             error_msg = f"处理打印任务失败: {str(e)}"
             self.logger.error(error_msg)
-            status_payload = {
-                "method": MQTTConfig.METHODS['print_status'],
-                "params": {
-                    "job_uuid": job_uuid,
-                    "state": 'error',
-                    "message": error_msg
-                },
-                "printerUUID": self.instance_name
-            }
-            self.publish_message(
-                MQTTConfig.TOPICS['print_status'],
-                status_payload
-            )
-            self.publish_message(
-                MQTTConfig.TOPICS['response'].format(**self.config),
-                status_payload
-            )
+            self._send_print_status(job_uuid, 'error', error_msg)
             return False
 
+    def _get_expected_hash(self, params: Dict[str, Any]) -> Optional[str]:
+        """获取 print.new 参数中的 SHA-256"""
+        expected = params.get('sha256') or params.get('fileHash')
+        if isinstance(expected, str) and re.fullmatch(r'[0-9a-fA-F]{64}', expected):
+            return expected.lower()
+        return None
+
+    async def find_reusable_file(self, files, file_key: str, expected_hash: Optional[str]) -> Optional[str]:
+        """查找可复用的本地文件：优先按哈希匹配，其次按 fileKey 匹配并校验"""
+        candidates = []
+        for file in files:
+            parsed = parse_managed_file_name(file['filename'])
+            if parsed:
+                candidates.append((file['filename'], parsed[2]))
+
+        loop = asyncio.get_event_loop()
+        if expected_hash:
+            # 每个文件一次缓存读取，在执行器中扫描避免阻塞事件循环
+            match = await loop.run_in_executor(None, self._find_cached_hash, candidates, expected_hash)
+            if match:
+                return match
+
+        for filename, candidate_key in candidates:
+            if candidate_key != file_key:
+                continue
+            if not expected_hash:
+                return filename
+            # 旧文件没有缓存哈希时计算一次并保存
+            cached_hash = self.load_file_cache(filename).get('sha256')
+            if not cached_hash:
+                try:
+                    cached_hash = await loop.run_in_executor(
+                        None, compute_file_hash, self.gcodes_path.joinpath(filename))
+                except Exception as e:
+                    self.logger.error(f"计算文件哈希失败: {str(e)}")
+                    continue
+                self.save_file_cache(filename, {'sha256': cached_hash})
+            if cached_hash == expected_hash:
+                return filename
+            self.logger.warning(f"文件 {filename} 哈希不匹配，重新下载")
+        return None
+
+    def _find_cached_hash(self, candidates: list, expected_hash: str) -> Optional[str]:
+        """按缓存的哈希查找文件（在执行器线程中调用）"""
+        for filename, _ in candidates:
+            if self.load_file_cache(filename).get('sha256') == expected_hash:
+                return filename
+        return None
+
     async def handle_existing_file(self, old_name: str, new_name: str, job_uuid: str) -> bool:
         """处理已存在的文件"""
         try:
@@ -266,7 +1494,8 @@ class MQTTListener:
                 headers={'Content-Type': 'application/json'},
                 method='POST'
             )
-            await loop.run_in_executor(None, urllib.request.urlopen, req)
+            if old_name != new_name:
+                await loop.run_in_executor(None, urllib.request.urlopen, req)
             
             # 开始打印
             print_url = f"{self.config['moonraker_api']}/printer/print/start"
@@ -285,45 +1514,16 @@ class MQTTListener:
             state_msg = f"文件重命名并开始打印: {new_name}"
             self.logger.info(state_msg)
 
-            status_payload = {
-                "method": MQTTConfig.METHODS['print_status'],
-                "params": {
-                    "job_uuid": job_uuid,
-                    "state": 'printing',
-                    "message": state_msg
-                },
-                "printerUUID": self.instance_name
-            }
-            self.publish_message(
-                MQTTConfig.TOPICS['print_status'],
-                status_payload
-            )
-            self.publish_message(
-                MQTTConfig.TOPICS['response'].format(**self.config),
-                status_payload
-            )
+            self.move_file_cache(old_name, new_name)
+            metadata = self.load_file_cache(new_name).get('metadata')
+            extra = {'metadata': metadata} if metadata else {}
+            self._send_print_status(job_uuid, 'printing', state_msg, **extra)
             return True
             
         except Exception as e:
             error_msg = f"处理已存在文件失败: {str(e)}"
             self.logger.error(error_msg)
-            status_payload = {
-                "method": MQTTConfig.METHODS['print_status'],
-                "params": {
-                    "job_uuid": job_uuid,
-                    "state": 'error',
-                    "message": error_msg
-                },
-                "printerUUID": self.instance_name
-            }
-            self.publish_message(
-                MQTTConfig.TOPICS['print_status'],
-                status_payload
-            )
-            self.publish_message(
-                MQTTConfig.TOPICS['response'].format(**self.config),
-                status_payload
-            )
+            self._send_print_status(job_uuid, 'error', error_msg)
             return False
 
     async def handle_new_file(self, params: Dict[str, Any]) -> bool:
@@ -337,85 +1537,12 @@ class MQTTListener:
             # 构造新文件名
             new_name = f"{file_name}-@-{job_uuid}-@-{file_key}.gcode"
             
-            # 下载文件并监控进度
-            loop = asyncio.get_event_loop()
-            req = urllib.request.Request(file_url)
-            response = await loop.run_in_executor(None, urllib.request.urlopen, req)
-            
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded_size = 0
-            file_content = bytearray()
-            last_report_time = time.time()
-            last_report_progress = 0
-            
-            while True:
-                chunk = await loop.run_in_executor(None, response.read, 8192)
-                if not chunk:
-                    break
-                    
-                file_content.extend(chunk)
-                downloaded_size += len(chunk)
-                
-                current_time = time.time()
-                current_progress = int(downloaded_size / total_size * 100)
-                
-                # 检查是否满足发送消息的条件
-                if (current_time - last_report_time >= 3) or (current_progress - last_report_progress >= 5):
-                    self._send_progress_status(
-                        job_uuid=job_uuid,
-                        file_name=file_name,
-                        progress=current_progress,
-                        uploaded=downloaded_size,
-                        total=total_size
-                    )
-                    last_report_time = current_time
-                    last_report_progress = current_progress
-            
-            # 上传文件到打印机
-            boundary = '----WebKitFormBoundary' + ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(16))
-            
-            content_type = f'multipart/form-data; boundary={boundary}'
-            
-            # 构建 multipart form-data
-            body = []
-            # 添加表单字段
-            body.append(f'--{boundary}'.encode())
-            body.append(b'Content-Disposition: form-data; name="path"')
-            body.append(b'')
-            body.append(b'')
-            
-            body.append(f'--{boundary}'.encode())
-            body.append(b'Content-Disposition: form-data; name="filename"')
-            body.append(b'')
-            body.append(new_name.encode())
-            
-            body.append(f'--{boundary}'.encode())
-            body.append(b'Content-Disposition: form-data; name="print"')
-            body.append(b'')
-            body.append(b'true')
-            
-            # 添加文件内容
-            body.append(f'--{boundary}'.encode())
-            body.append(f'Content-Disposition: form-data; name="file"; filename="{new_name}"'.encode())
-            body.append(b'Content-Type: application/octet-stream')
-            body.append(b'')
-            body.append(bytes(file_content))
-            
-            body.append(f'--{boundary}--'.encode())
-            body.append(b'')
-            
-            body = b'\r\n'.join(body)
-            
-            req = urllib.request.Request(
-                f"{self.config['moonraker_api']}/server/files/upload",
-                data=body,
-                headers={'Content-Type': content_type},
-                method='POST'
-            )
-            
-            await loop.run_in_executor(None, urllib.request.urlopen, req)
+            # 磁盘空间不足时先清理旧文件
+            await self.run_disk_cleanup()
+            metadata = await self.download_and_upload(params, new_name, start_print=True)
             
             # 检查打印机状态
+            loop = asyncio.get_event_loop()
             status_url = f"{self.config['moonraker_api']}/printer/objects/query?print_stats"
             response = await loop.run_in_executor(None, urllib.request.urlopen, status_url)
             printer_status = json.loads(await loop.run_in_executor(None, response.read))
@@ -425,70 +1552,640 @@ class MQTTListener:
                 self.logger.info(f"文件 {new_name} 上传成功并已开始打印")
                 
                 # 发送任务状态消息
-                status_payload = {
-                    "method": MQTTConfig.METHODS['print_status'],
-                    "params": {
-                        "job_uuid": job_uuid,
-                        "state": 'printing',
-                        "message": f"文件 {new_name} 正在打印"
-                    },
-                    "printerUUID": self.instance_name
-                }
-                self.publish_message(
-                    MQTTConfig.TOPICS['print_status'],
-                    status_payload
-                )
-                self.publish_message(
-                    MQTTConfig.TOPICS['response'].format(**self.config),
-                    status_payload
-                )
+                self._send_print_status(job_uuid, 'printing', f"文件 {new_name} 正在打印", metadata=metadata)
                 
                 return True
             else:
                 error_msg = f"文件已上传但未开始打印，当前状态: {print_state}"
                 self.logger.error(error_msg)
-                status_payload = {
-                    "method": MQTTConfig.METHODS['print_status'],
-                    "params": {
-                        "job_uuid": job_uuid,
-                        "state": print_state,
-                        "message": error_msg
-                    },
-                    "printerUUID": self.instance_name
-                }
-                self.publish_message(
-                    MQTTConfig.TOPICS['print_status'],
-                    status_payload
-                )
-                self.publish_message(
-                    MQTTConfig.TOPICS['response'].format(**self.config),
-                    status_payload
-                )
+                self._send_print_status(job_uuid, print_state, error_msg, metadata=metadata)
                 return False
                 
         except Exception as e:
             error_msg = f"处理新文件失败: {str(e)}"
             self.logger.error(error_msg)
-            status_payload = {
-                "method": MQTTConfig.METHODS['print_status'],
-                "params": {
-                    "job_uuid": job_uuid,
-                    "state": 'error',
-                    "message": error_msg
-                },
-                "printerUUID": self.instance_name
-            }
-            self.publish_message(
-                MQTTConfig.TOPICS['print_status'],
-                status_payload
-            )
-            self.publish_message(
-                MQTTConfig.TOPICS['response'].format(**self.config),
-                status_payload
-            )
+            self._send_print_status(job_uuid, 'error', error_msg)
             # self.send_error_message(error_msg)
             return False
 
+    async def download_and_upload(self, params: Dict[str, Any], new_name: str, start_print: bool) -> Dict[str, Any]:
+        """下载、校验并上传文件到打印机，返回解析出的元数据"""
+        if self.transfer_worker:
+            return await self._transfer_with_worker(params, new_name, start_print)
+
+        file_name = params['fileName']
+        job_uuid = params.get('printjobuuid', '')
+        file_url = params['fileUrl']
+
+        # 下载文件并监控进度
+        loop = asyncio.get_event_loop()
+        req = urllib.request.Request(file_url)
+        response = await loop.run_in_executor(None, urllib.request.urlopen, req)
+        
+        total_size = int(response.headers.get('content-length', 0) or 0)
+        downloaded_size = 0
+        file_content = bytearray()
+        metadata_parser = GcodeMetadataParser()
+        layer_builder = LayerIndexBuilder()
+
+        # 边下载边计算哈希，ETag 为 MD5 时同时计算 MD5
+        etag = parse_etag(response.headers)
+        expected_hash, use_md5 = resolve_expected_hash(self._get_expected_hash(params), etag)
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5() if use_md5 else None
+        last_report_time = time.time()
+        last_report_progress = 0
+        
+        while True:
+            chunk = await loop.run_in_executor(None, response.read, 8192)
+            if not chunk:
+                break
+                
+            await self.governor.throttle_download(len(chunk))
+            file_content.extend(chunk)
+            metadata_parser.feed(chunk)
+            layer_builder.feed(chunk)
+            sha256.update(chunk)
+            if md5:
+                md5.update(chunk)
+            downloaded_size += len(chunk)
+            
+            current_time = time.time()
+            current_progress = int(downloaded_size / total_size * 100) if total_size else 0
+            
+            # 检查是否满足发送消息的条件
+            if (current_time - last_report_time >= 3) or (current_progress - last_report_progress >= 5):
+                self._send_progress_status(
+                    job_uuid=job_uuid,
+                    file_name=file_name,
+                    progress=current_progress,
+                    uploaded=downloaded_size,
+                    total=total_size
+                )
+                last_report_time = current_time
+                last_report_progress = current_progress
+
+        metadata = metadata_parser.finish()
+        layer_index = layer_builder.finish(metadata.get('estimated_time'))
+
+        file_hash = sha256.hexdigest()
+        verify_download(total_size, downloaded_size, file_hash, expected_hash,
+                        md5.hexdigest() if md5 else None, etag)
+        
+        # 上传文件到打印机
+        head, tail, content_type = build_multipart_head(new_name, start_print)
+        
+        # 分块发送文件内容，打印时按限速写入
+        req = urllib.request.Request(
+            f"{self.config['moonraker_api']}/server/files/upload",
+            data=self._iter_upload_body(head, file_content, tail),
+            headers={
+                'Content-Type': content_type,
+                'Content-Length': str(len(head) + len(file_content) + len(tail))
+            },
+            method='POST'
+        )
+        
+        await loop.run_in_executor(None, urllib.request.urlopen, req)
+        self.save_file_cache(new_name, {'metadata': metadata, 'sha256': file_hash})
+        self.save_layer_index(new_name, layer_index)
+        return metadata
+
+    async def _transfer_with_worker(self, params: Dict[str, Any], new_name: str, start_print: bool) -> Dict[str, Any]:
+        """由传输子进程下载到临时文件并上传，主进程只处理进度事件"""
+        job_uuid = params.get('printjobuuid', '')
+        temp_path = self.file_cache_path.joinpath('tmp', f"{new_name}.part")
+        index_path = self._get_layer_index_path(new_name)
+        report = {'time': time.time(), 'progress': 0}
+
+        def on_download_progress(event: Dict[str, Any]):
+            self.governor.download.record(event.get('delta', 0))
+            self.governor.disk_write.record(event.get('delta', 0))
+            total_size = event.get('total', 0)
+            current_progress = int(event['downloaded'] / total_size * 100) if total_size else 0
+            current_time = time.time()
+            if (current_time - report['time'] >= 3) or (current_progress - report['progress'] >= 5):
+                self._send_progress_status(
+                    job_uuid=job_uuid,
+                    file_name=params['fileName'],
+                    progress=current_progress,
+                    uploaded=event['downloaded'],
+                    total=total_size
+                )
+                report.update(time=current_time, progress=current_progress)
+
+        try:
+            result = await self.transfer_worker.request('download', {
+                'url': params['fileUrl'],
+                'path': str(temp_path),
+                'index_path': str(index_path),
+                'expected_sha256': self._get_expected_hash(params)
+            }, on_download_progress)
+            await self.transfer_worker.request('upload', {
+                'url': f"{self.config['moonraker_api']}/server/files/upload",
+                'path': str(temp_path),
+                'filename': new_name,
+                'print': start_print
+            }, lambda event: self.governor.disk_write.record(event.get('delta', 0)))
+        except BaseException:
+            try:
+                index_path.unlink()
+            except FileNotFoundError:
+                pass
+            raise
+        finally:
+            try:
+                temp_path.unlink()
+            except FileNotFoundError:
+                pass
+
+        metadata = result['metadata']
+        self.save_file_cache(new_name, {'metadata': metadata, 'sha256': result['sha256']})
+        return metadata
+
+    def _iter_upload_body(self, head: bytes, content, tail: bytes):
+        """生成上传请求体，在执行器线程中按磁盘写入限速"""
+        yield head
+        view = memoryview(content)
+        for offset in range(0, len(view), self.upload_chunk_size):
+            part = view[offset:offset + self.upload_chunk_size]
+            self.governor.throttle_disk_write(len(part))
+            yield bytes(part)
+        yield tail
+
+    def _post_moonraker(self, path: str, data: Optional[Dict[str, Any]] = None, timeout: float = None):
+        """向 Moonraker 发送 POST 请求（在执行器线程中调用）"""
+        req = urllib.request.Request(
+            f"{self.config['moonraker_api']}{path}",
+            data=json.dumps(data or {}).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        with urllib.request.urlopen(req, timeout=timeout or self.control_timeout) as response:
+            return response.read()
+
+    def _run_in_thread(self, func: Callable, *args) -> asyncio.Future:
+        """在新建的线程中执行阻塞调用，不与任何线程池共享"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def set_result(result, error):
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        def run():
+            try:
+                result = func(*args)
+            except Exception as e:
+                loop.call_soon_threadsafe(set_result, None, e)
+            else:
+                loop.call_soon_threadsafe(set_result, result, None)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def _send_control_response(self, method: str, request: Dict[str, Any], params: Dict[str, Any]):
+        if request.get('requestId'):
+            params["requestId"] = request['requestId']
+        self.publish_envelope(MQTTConfig.TOPICS['response'], method, params, qos=1)
+
+    async def _run_control(self, method: str, request: Dict[str, Any], path: str,
+                           data: Optional[Dict[str, Any]] = None, dedicated: bool = False, **extra):
+        """执行打印控制请求并返回带执行耗时的确认，dedicated 为 True 时不使用线程池"""
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        params = {}
+        try:
+            if dedicated:
+                await self._run_in_thread(self._post_moonraker, path, data, MQTTConfig.EMERGENCY_STOP_TIMEOUT)
+            else:
+                await loop.run_in_executor(self.control_executor, self._post_moonraker, path, data)
+            params["status"] = "success"
+        except Exception as e:
+            params["status"] = "error"
+            params["message"] = str(e)
+            self.logger.error(f"执行 {method} 失败: {str(e)}")
+        params["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        params.update(extra)
+        self._send_control_response(method, request, params)
+        self.logger.info(f"{method} 完成，耗时 {params['latency_ms']} ms")
+
+    async def handle_print_control(self, payload: Dict[str, Any]):
+        """处理暂停、恢复和取消"""
+        method = payload.get('method', '')
+        request = payload.get('params') or {}
+        await self._run_control(method, request, self.control_methods[method])
+
+    async def handle_emergency_stop(self, payload: Dict[str, Any]):
+        """处理急停，不经过调度队列和控制线程池"""
+        method = MQTTConfig.METHODS['emergency_stop']
+        request = payload.get('params') or {}
+        await self._run_control(method, request, self.control_methods[method], dedicated=True)
+
+    async def handle_gcode_script(self, payload: Dict[str, Any]):
+        """执行 gcode 脚本，多行命令合并为一次 Klipper 调用"""
+        method = MQTTConfig.METHODS['gcode_script']
+        request = payload.get('params') or {}
+        lines = request.get('lines')
+        if isinstance(lines, list):
+            script = "\n".join(str(line) for line in lines)
+        else:
+            script = request.get('script', '')
+        if not isinstance(script, str):
+            self._send_control_response(method, request, {"status": "error", "message": "script 必须是字符串"})
+            return
+        if not script.strip():
+            self._send_control_response(method, request, {"status": "error", "message": "缺少 gcode 脚本"})
+            return
+        await self._run_control(
+            method, request, "/printer/gcode/script", {'script': script},
+            lines=script.count("\n") + 1
+        )
+
+    async def handle_transfer_status(self, payload: Dict[str, Any] = None):
+        """返回当前传输限速和使用情况"""
+        self.publish_envelope(
+            MQTTConfig.TOPICS['response'],
+            MQTTConfig.METHODS['transfer_status'],
+            self.governor.get_status(),
+            qos=0
+        )
+
+    def _list_managed_files(self) -> list:
+        """扫描 gcodes 目录中由 C3P 管理的文件（在执行器线程中调用）"""
+        files = []
+        try:
+            entries = list(os.scandir(self.gcodes_path))
+        except FileNotFoundError:
+            return files
+        for entry in entries:
+            parsed = parse_managed_file_name(entry.name)
+            if not parsed or not entry.is_file():
+                continue
+            stat = entry.stat()
+            files.append({
+                "filename": entry.name,
+                "name": parsed[0],
+                "job_uuid": parsed[1],
+                "file_key": parsed[2],
+                "size": stat.st_size,
+                "modified": stat.st_mtime
+            })
+        return files
+
+    def _filter_managed_files(self, files: list, params: Dict[str, Any]) -> list:
+        """按任务、fileKey、名称和修改时间过滤文件"""
+        def as_set(value):
+            if not value:
+                return None
+            return set(value) if isinstance(value, list) else {value}
+
+        job_uuids = as_set(params.get('jobUuid'))
+        file_keys = as_set(params.get('fileKey'))
+        name = params.get('name')
+        older_than = params.get('olderThan')
+        result = []
+        for file in files:
+            if job_uuids and file['job_uuid'] not in job_uuids:
+                continue
+            if file_keys and file['file_key'] not in file_keys:
+                continue
+            if name and name not in file['name']:
+                continue
+            if older_than and file['modified'] >= float(older_than):
+                continue
+            result.append(file)
+        return result
+
+    def _delete_files(self, filenames: list) -> Tuple[list, list]:
+        """通过 Moonraker 删除文件（在执行器线程中调用）"""
+        deleted = []
+        failed = []
+        for filename in filenames:
+            if filename == self.current_print_file:
+                failed.append({"filename": filename, "error": "文件正在打印"})
+                continue
+            url = f"{self.config['moonraker_api']}/server/files/gcodes/{urllib.parse.quote(filename)}"
+            try:
+                urllib.request.urlopen(urllib.request.Request(url, method='DELETE'))
+            except Exception as e:
+                failed.append({"filename": filename, "error": str(e)})
+                continue
+            for cache_path in (self._get_file_cache_path(filename), self._get_layer_index_path(filename)):
+                try:
+                    cache_path.unlink()
+                except FileNotFoundError:
+                    pass
+            deleted.append(filename)
+        return deleted, failed
+
+    def _get_disk_usage(self) -> Dict[str, Any]:
+        usage = shutil.disk_usage(self.gcodes_path)
+        files = self._list_managed_files()
+        return {
+            "total": usage.total,
+            "used": usage.used,
+            "free": usage.free,
+            "managed_files": len(files),
+            "managed_size": sum(file['size'] for file in files),
+            "cleanup": {
+                "min_free": self.cleanup_min_free,
+                "target_free": self.cleanup_target_free,
+                "keep_hours": self.cleanup_keep_hours
+            }
+        }
+
+    def _send_files_response(self, method: str, request: Dict[str, Any], params: Dict[str, Any]):
+        """发送文件管理响应，带回请求中的 requestId"""
+        if request.get('requestId'):
+            params["requestId"] = request['requestId']
+        self.publish_envelope(MQTTConfig.TOPICS['response'], method, params, qos=0)
+
+    def _build_file_page(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """列出、过滤、排序并分页，同时读取本页文件的缓存（在执行器线程中调用）"""
+        files = self._filter_managed_files(self._list_managed_files(), params)
+
+        sort_key = params.get('sort', 'modified')
+        if sort_key not in ('modified', 'size', 'name'):
+            sort_key = 'modified'
+        files.sort(key=lambda file: file[sort_key], reverse=params.get('order', 'desc') != 'asc')
+
+        page = max(1, int(params.get('page', 1)))
+        page_size = min(self.max_page_size, max(1, int(params.get('pageSize', 50))))
+        page_files = files[(page - 1) * page_size:page * page_size]
+        for file in page_files:
+            cache = self.load_file_cache(file['filename'])
+            file['sha256'] = cache.get('sha256')
+            if params.get('withMetadata') and cache.get('metadata'):
+                metadata = dict(cache['metadata'])
+                metadata.pop('thumbnail', None)
+                file['metadata'] = metadata
+
+        return {
+            "total": len(files),
+            "page": page,
+            "pageSize": page_size,
+            "files": page_files
+        }
+
+    async def handle_files_list(self, payload: Dict[str, Any]):
+        """分页列出受管理的文件"""
+        method = MQTTConfig.METHODS['files_list']
+        params = payload.get('params') or {}
+        try:
+            loop = asyncio.get_event_loop()
+            result = await loop.run_in_executor(None, self._build_file_page, params)
+            result["status"] = "success"
+            self._send_files_response(method, params, result)
+        except Exception as e:
+            error_msg = f"获取文件列表失败: {str(e)}"
+            self.logger.error(error_msg)
+            self._send_files_response(method, params, {"status": "error", "message": error_msg})
+
+    async def handle_files_delete(self, payload: Dict[str, Any]):
+        """批量删除文件，可指定文件名列表或过滤条件"""
+        method = MQTTConfig.METHODS['files_delete']
+        params = payload.get('params') or {}
+        try:
+            loop = asyncio.get_event_loop()
+            filenames = params.get('filenames')
+            rejected = []
+            if filenames:
+                # 只允许 gcodes 根目录下的受管理文件，拒绝包含路径分隔符的文件名
+                targets = []
+                for name in filenames:
+                    if (isinstance(name, str) and not any(sep in name for sep in ('/', '\\', '\0'))
+                            and parse_managed_file_name(name)):
+                        targets.append(name)
+                    else:
+                        rejected.append({"filename": name, "error": "无效的文件名"})
+            elif any(params.get(key) for key in ('jobUuid', 'fileKey', 'name', 'olderThan')):
+                files = await loop.run_in_executor(None, self._list_managed_files)
+                targets = [file['filename'] for file in self._filter_managed_files(files, params)]
+            else:
+                raise ValueError("缺少删除条件")
+
+            deleted, failed = await loop.run_in_executor(None, self._delete_files, targets)
+            failed = rejected + failed
+            self.logger.info(f"批量删除文件: 成功 {len(deleted)} 个, 失败 {len(failed)} 个")
+            self._send_files_response(method, params, {
+                "status": "success",
+                "deleted": deleted,
+                "failed": failed
+            })
+        except Exception as e:
+            error_msg = f"批量删除文件失败: {str(e)}"
+            self.logger.error(error_msg)
+            self._send_files_response(method, params, {"status": "error", "message": error_msg})
+
+    async def handle_files_prefetch(self, payload: Dict[str, Any]):
+        """批量预下载文件到打印机，不开始打印"""
+        method = MQTTConfig.METHODS['files_prefetch']
+        params = payload.get('params') or {}
+        results = []
+        try:
+            loop = asyncio.get_event_loop()
+            files = await loop.run_in_executor(None, self._list_managed_files)
+            for item in params.get('files') or []:
+                if not isinstance(item, dict):
+                    results.append({"fileKey": None, "status": "error", "message": "无效的文件条目"})
+                    continue
+                file_key = item.get('fileKey')
+                if not all([file_key, item.get('fileUrl'), item.get('fileName')]):
+                    results.append({"fileKey": file_key, "status": "error", "message": "缺少必要参数"})
+                    continue
+
+                match = await self.find_reusable_file(files, file_key, self._get_expected_hash(item))
+                if match:
+                    results.append({"fileKey": file_key, "filename": match, "status": "exists"})
+                    continue
+
+                item = dict(item)
+                item.setdefault('printjobuuid', 'prefetch')
+                new_name = f"{item['fileName']}-@-{item['printjobuuid']}-@-{file_key}.gcode"
+                try:
+                    await self.run_disk_cleanup()
+                    await self.download_and_upload(item, new_name, start_print=False)
+                    files.append({"filename": new_name})
+                    results.append({"fileKey": file_key, "filename": new_name, "status": "downloaded"})
+                except Exception as e:
+                    self.logger.error(f"预下载文件失败 {new_name}: {str(e)}")
+                    results.append({"fileKey": file_key, "status": "error", "message": str(e)})
+
+            self._send_files_response(method, params, {"status": "success", "files": results})
+        except Exception as e:
+            error_msg = f"批量预下载失败: {str(e)}"
+            self.logger.error(error_msg)
+            self._send_files_response(method, params, {"status": "error", "message": error_msg, "files": results})
+
+    async def handle_files_usage(self, payload: Dict[str, Any] = None):
+        """返回磁盘使用情况"""
+        method = MQTTConfig.METHODS['files_usage']
+        params = (payload or {}).get('params') or {}
+        try:
+            loop = asyncio.get_event_loop()
+            usage = await loop.run_in_executor(None, self._get_disk_usage)
+            usage["status"] = "success"
+            self._send_files_response(method, params, usage)
+        except Exception as e:
+            error_msg = f"获取磁盘使用情况失败: {str(e)}"
+            self.logger.error(error_msg)
+            self._send_files_response(method, params, {"status": "error", "message": error_msg})
+
+    async def run_disk_cleanup(self) -> list:
+        """剩余空间低于阈值时删除最旧的受管理文件"""
+        async with self.cleanup_lock:
+            loop = asyncio.get_event_loop()
+            try:
+                return await loop.run_in_executor(None, self._cleanup_disk)
+            except Exception as e:
+                self.logger.error(f"自动清理文件失败: {str(e)}")
+                return []
+
+    def _cleanup_disk(self) -> list:
+        free = shutil.disk_usage(self.gcodes_path).free
+        if free >= self.cleanup_min_free:
+            return []
+
+        cutoff = time.time() - self.cleanup_keep_hours * 3600
+        candidates = sorted(
+            (file for file in self._list_managed_files() if file['modified'] < cutoff),
+            key=lambda file: file['modified']
+        )
+        needed = self.cleanup_target_free - free
+        targets = []
+        for file in candidates:
+            if needed <= 0:
+                break
+            if file['filename'] == self.current_print_file:
+                continue
+            targets.append(file['filename'])
+            needed -= file['size']
+
+        deleted, failed = self._delete_files(targets)
+        self.logger.info(f"磁盘剩余空间不足，已自动删除 {len(deleted)} 个文件，失败 {len(failed)} 个")
+        return deleted
+
+    def _get_file_cache_path(self, file_name: str) -> pathlib.Path:
+        return self.file_cache_path.joinpath(f"{file_name}.json")
+
+    def load_file_cache(self, file_name: str) -> Dict[str, Any]:
+        """读取文件旁的元数据缓存"""
+        try:
+            with self._get_file_cache_path(file_name).open('r') as cache_file:
+                return json.load(cache_file)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.logger.error(f"读取文件缓存失败: {str(e)}")
+            return {}
+
+    def save_file_cache(self, file_name: str, data: Dict[str, Any]):
+        """合并写入文件元数据缓存"""
+        try:
+            cache = self.load_file_cache(file_name)
+            cache.update(data)
+            cache_path = self._get_file_cache_path(file_name)
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = cache_path.with_suffix('.tmp')
+            with temp_path.open('w') as cache_file:
+                json.dump(cache, cache_file, ensure_ascii=False)
+            os.replace(temp_path, cache_path)
+        except Exception as e:
+            self.logger.error(f"保存文件缓存失败: {str(e)}")
+
+    def move_file_cache(self, old_name: str, new_name: str):
+        try:
+            for get_path in (self._get_file_cache_path, self._get_layer_index_path):
+                old_path = get_path(old_name)
+                if old_path.exists():
+                    os.replace(old_path, get_path(new_name))
+        except Exception as e:
+            self.logger.error(f"移动文件缓存失败: {str(e)}")
+
+    def _get_layer_index_path(self, file_name: str) -> pathlib.Path:
+        return self.file_cache_path.joinpath(f"{file_name}.layers")
+
+    def save_layer_index(self, file_name: str, layer_index: LayerIndex):
+        try:
+            layer_index.save(self._get_layer_index_path(file_name))
+        except Exception as e:
+            self.logger.error(f"保存层索引失败: {str(e)}")
+
+    def _load_or_build_layer_index(self, file_name: str) -> Optional[LayerIndex]:
+        """读取缓存的层索引，缺失或过期时扫描本地文件重建（在执行器线程中调用）"""
+        file_path = self.gcodes_path.joinpath(file_name)
+        file_size = file_path.stat().st_size
+        layer_index = LayerIndex.load(self._get_layer_index_path(file_name))
+        if layer_index and layer_index.file_size == file_size:
+            return layer_index
+
+        metadata = self.load_file_cache(file_name).get('metadata')
+        metadata_parser = None if metadata else GcodeMetadataParser()
+        layer_builder = LayerIndexBuilder()
+        with file_path.open('rb') as gcode_file:
+            while True:
+                chunk = gcode_file.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                layer_builder.feed(chunk)
+                if metadata_parser:
+                    metadata_parser.feed(chunk)
+        if metadata_parser:
+            metadata = metadata_parser.finish()
+            self.save_file_cache(file_name, {'metadata': metadata})
+        layer_index = layer_builder.finish(metadata.get('estimated_time'))
+        self.save_layer_index(file_name, layer_index)
+        self.logger.info(f"已为 {file_name} 建立层索引，共 {len(layer_index.offsets)} 层")
+        return layer_index
+
+    async def load_layer_index(self, file_name: str):
+        loop = asyncio.get_event_loop()
+        try:
+            layer_index = await loop.run_in_executor(None, self._load_or_build_layer_index, file_name)
+        except Exception as e:
+            self.logger.error(f"加载层索引失败: {str(e)}")
+            return
+        if self.layer_index_file == file_name:
+            self.layer_index = layer_index
+
+    def get_print_progress(self, position: Optional[int]) -> Optional[Dict[str, Any]]:
+        """根据文件位置查询当前层、进度和剩余时间"""
+        file_name = self.current_print_file
+        if not file_name or position is None:
+            return None
+        if file_name != self.layer_index_file:
+            self.layer_index_file = file_name
+            self.layer_index = None
+            # 清除上一个文件的进度，避免新索引加载完成前发布旧值
+            self.status_model.update({'progress': dict.fromkeys(MQTTConfig.PROGRESS_FIELDS)})
+            asyncio.create_task(self.load_layer_index(file_name))
+        if self.layer_index is None:
+            return None
+        return self.layer_index.lookup(position)
+
+    def _send_print_status(self, job_uuid: str, state: str, message: str, **extra):
+        """发送打印任务状态到状态主题和响应主题"""
+        params = {
+            "job_uuid": job_uuid,
+            "state": state,
+            "message": message
+        }
+        params.update(extra)
+        status_payload = self.codec.encode_envelope(MQTTConfig.METHODS['print_status'], params)
+        self.publish_message(
+            MQTTConfig.TOPICS['print_status'],
+            status_payload
+        )
+        self.publish_message(
+            MQTTConfig.TOPICS['response'],
+            status_payload
+        )
+
     def _send_progress_status(self, file_name: str, job_uuid: str, progress: int, uploaded: int = 0, total: int = 0):
         """发送进度状态"""
         status = {
@@ -500,36 +2197,38 @@ class MQTTListener:
             # "timestamp": int(time.time())
         }
         
-        status_payload = {
-            "method": MQTTConfig.METHODS['print_progress'],
-            "params": status,
-            "printerUUID": self.instance_name
-        }
-        
-        self.publish_message(
+        self.publish_envelope(
             MQTTConfig.TOPICS['response'],
-            status_payload
+            MQTTConfig.METHODS['print_progress'],
+            status
         )
 
 
-    def publish_message(self, topic: str, payload: Dict[str, Any], retain: bool = False, qos: int = 1):
-        """发布消息到 MQTT"""
+    def publish_message(self, topic: str, payload: Any, retain: bool = False, qos: int = 1):
+        """发布消息到 MQTT，payload 可以是字典或已编码的字符串"""
         try:
             # 如果 topic 中包含 {instance_name}，进行替换
-            if "{instance_name}" in topic:
-                topic = topic.format(instance_name=self.instance_name)
+            topic = self.codec.render_topic(topic)
                 
-            message = json.dumps(payload, ensure_ascii=False)
+            message = payload if isinstance(payload, str) else self.codec.dumps(payload)
             self.mqtt.publish_topic(topic, message, retain=retain, qos=qos)
             self.logger.info(f"消息已发布到 MQTT - Topic: {topic}")
             # self.logger.info(f"消息内容: {message}")
         except Exception as e:
             self.logger.error(f"发布 MQTT 消息失败: {str(e)}")
 
+    def publish_envelope(self, topic: str, method: str, params: Any, retain: bool = False, qos: int = 1):
+        """使用缓存的信封前缀编码并发布消息"""
+        self.publish_message(topic, self.codec.encode_envelope(method, params), retain=retain, qos=qos)
+
 
     def cleanup(self):
         """清理资源"""
         try:
+            self.dispatcher.cancel_all()
+            self.control_executor.shutdown(wait=False)
+            if self.transfer_worker:
+                self.transfer_worker.stop()
             if self.stop_status_check:
                 self.stop_status_check.set()
             if self.ws_client:
@@ -545,7 +2244,7 @@ class MQTTListener:
             self.logger.info("WebSocket 连接成功")
             
             # 订阅状态更新
-            await self.get_printer_status()
+            await self.get_printer_status(subscribe=True)
             
             # 启动状态检查
             self.stop_status_check = asyncio.Event()
@@ -570,62 +2269,284 @@ class MQTTListener:
     async def handle_websocket_message(self, msg: str):
         """处理 websocket 消息"""
         try:
-            data = json.loads(msg)
+            data = self.codec.loads(msg)
             # self.logger.info(f"收到消息: {data}")
             
             if "result" in data:
                 status = data['result'].get('status', {})
                 self.process_status_message(status)
+            elif data.get('method') == "notify_status_update":
+                # 订阅推送只包含变化的字段
+                self.process_status_message(data['params'][0])
             else:
                 # self.logger.warning("收到不相关的消息，忽略")
                 pass
                 
-        except json.JSONDecodeError:
+        except ValueError:
             self.logger.error("JSON解析错误")
         except Exception as e:
             self.logger.error(f"处理 WebSocket 消息失败: {str(e)}")
 
     def process_status_message(self, status: Dict[str, Any]):
         """处理状态消息"""
-        if 'webhooks' in status or 'print_stats' in status:
-            # self.logger.info("处理包含 'webhooks' 或 'print_stats' 的消息")
-            
-            status_data = {
-                "method": "printer.status",
-                "printerUUID": self.instance_name,
-                "params": {
-                    "state": status.get('webhooks', {}).get('state', 'unknown'),
-                    "message": status.get('webhooks', {}).get('state_message', ''),
-                    "print_stats": status.get('print_stats', {}),
-                    # "timestamp": int(time.time())
-                }
-            }
-            
-            # 检查状态是否变化
-            if status_data != self.previous_status_data:
-                self.logger.info("状态已变化，发送消息")
-                self.publish_status_message(status_data)
-                self.previous_status_data = status_data
-                self.same_status_count = 0
+        self.last_status_update = time.time()
+        model = self.status_model
+        model.update(status)
+
+        print_state = model.get('print_stats', 'state')
+        if print_state:
+            self.governor.set_state(print_state)
+            if print_state in ('printing', 'paused'):
+                self.current_print_file = model.get('print_stats', 'filename')
             else:
-                self.same_status_count += 1
-                # self.logger.info(f"状态未变化，计数: {self.same_status_count}")
-                if self.same_status_count >= self.max_same_status_count:
-                    # self.logger.info("状态未变化达到10次，发送消息")
-                    self.publish_status_message(status_data)
-                    self.same_status_count = 0
-        else:
-            self.logger.warning("消息中缺少 'webhooks' 和 'print_stats'，忽略")
+                self.current_print_file = None
+
+        progress = self.get_print_progress(model.get('virtual_sdcard', 'file_position'))
+        if progress:
+            model.update({'progress': progress})
+
+        self.update_timelapse()
+        self.flush_status()
+
+    def flush_status(self, force: bool = False):
+        """有变化时发布状态，关键字段变化立即发布，其余按最小间隔合并"""
+        model = self.status_model
+        if not model.dirty and not force:
+            return
+        now = time.time()
+        if not force and not model.has_urgent_changes() and now - self.last_status_publish < self.status_min_interval:
+            return
+        if model.get('webhooks', 'state') is None and model.get('print_stats', 'state') is None:
+            return
 
-    def publish_status_message(self, status_data):
+        self.publish_status_message(self.build_status_params())
+        model.clear_dirty()
+        self.last_status_publish = now
+
+    def build_status_params(self) -> Dict[str, Any]:
+        """根据状态模型生成 printer.status 参数"""
+        objects = self.status_model.to_dict()
+        webhooks = objects.pop('webhooks', {})
+        params = {
+            "state": webhooks.get('state', 'unknown'),
+            "message": webhooks.get('state_message', ''),
+            "print_stats": objects.pop('print_stats', {}),
+            "version": self.status_model.version,
+        }
+        progress = objects.pop('progress', None)
+        if progress and self.current_print_file:
+            params["progress"] = progress
+        params["status"] = objects
+        return params
+
+    def publish_status_message(self, params: Dict[str, Any]):
         """发布状态消息到 MQTT"""
-        self.publish_message(
+        self.publish_envelope(
             MQTTConfig.TOPICS['printer_status'],
-            status_data,
+            MQTTConfig.METHODS['printer_status'],
+            params,
             retain=True,
             qos=1
         )
-        self.logger.info(f"已发送状态消息: {status_data}")
+        self.logger.info(f"已发送状态消息，版本: {params['version']}")
+
+    def update_timelapse(self):
+        """根据打印状态开始、触发或结束延时摄影"""
+        if not self.timelapse_enabled:
+            return
+        print_state = self.status_model.get('print_stats', 'state')
+        session = self.timelapse_session
+        if print_state in ('printing', 'paused'):
+            if session is None:
+                session = self._start_timelapse()
+            now = time.time()
+            layer = self._get_current_layer()
+            if print_state == 'printing' and session.should_capture(layer, now):
+                session.mark(layer, now)
+                session.capture_task = asyncio.create_task(self._capture_timelapse_frame(session))
+        elif print_state and session is not None:
+            self.timelapse_session = None
+            asyncio.create_task(self._finish_timelapse(session, print_state))
+
+    def _start_timelapse(self) -> TimelapseSession:
+        file_name = self.current_print_file or ''
+        parsed = parse_managed_file_name(file_name)
+        job_uuid = parsed[1] if parsed else ''
+        session_id = job_uuid or f"{pathlib.Path(file_name).stem}-{int(time.time())}"
+        session_id = re.sub(r'[^\w.-]', '_', session_id)
+        session = TimelapseSession(
+            session_id,
+            job_uuid,
+            self.timelapse_path.joinpath(f"{session_id}.frames"),
+            self.timelapse_max_bytes,
+            self.timelapse_mode,
+            self.timelapse_interval
+        )
+        # 清除同一任务上次中断时遗留的帧
+        session.clear()
+        self.timelapse_session = session
+        self.logger.info(f"开始延时摄影: {session_id}")
+        return session
+
+    def _get_current_layer(self) -> Optional[int]:
+        """优先使用层索引计算的当前层，其次使用 print_stats.info"""
+        layer = self.status_model.get('progress', 'current_layer')
+        if layer is None:
+            info = self.status_model.get('print_stats', 'info') or {}
+            layer = info.get('current_layer')
+        return layer
+
+    async def _capture_timelapse_frame(self, session: TimelapseSession):
+        """取一帧写入环形缓冲"""
+        url = f"{self.config['moonraker_api']}/webcam/snapshot?timestamp={int(time.time())}"
+        path = session.next_path()
+        try:
+            if self.transfer_worker:
+                result = await self.transfer_worker.request('snapshot', {'url': url, 'path': str(path)})
+                size = result['size']
+            else:
+                loop = asyncio.get_event_loop()
+                size = await loop.run_in_executor(None, save_snapshot, url, path)
+            session.commit(size)
+        except Exception as e:
+            self.logger.warning(f"延时摄影取帧失败: {str(e)}")
+
+    async def _finish_timelapse(self, session: TimelapseSession, print_state: str):
+        """打印结束后合成并发布，随后删除帧"""
+        loop = asyncio.get_event_loop()
+        try:
+            if session.capture_task:
+                await session.capture_task
+            if print_state not in TimelapseSession.RENDER_STATES or not session.frames:
+                self.logger.info(f"延时摄影结束，不合成: {session.session_id}, 状态: {print_state}")
+                return
+            output = await self._assemble_timelapse(session)
+            await loop.run_in_executor(None, self._prune_timelapse)
+            self.logger.info(f"延时摄影合成完成: {output.name}")
+            await self.publish_timelapse(output, session.job_uuid, frames=len(session.frames))
+        except Exception as e:
+            self.logger.error(f"延时摄影合成失败: {str(e)}")
+        finally:
+            await loop.run_in_executor(None, session.clear)
+
+    async def _assemble_timelapse(self, session: TimelapseSession) -> pathlib.Path:
+        """使用低优先级的 ffmpeg 合成视频，没有 ffmpeg 或合成失败时生成拼图"""
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg:
+            output = self.timelapse_path.joinpath(f"{session.session_id}.mp4")
+            temp_path = output.with_suffix('.part')
+            command = []
+            if shutil.which('nice'):
+                command += ['nice', '-n', '19']
+            if shutil.which('ionice'):
+                command += ['ionice', '-c', '3']
+            command += [
+                ffmpeg, '-y', '-loglevel', 'error',
+                '-framerate', str(self.timelapse_fps),
+                '-start_number', str(session.get_first_seq()),
+                '-i', str(session.path.joinpath(TimelapseSession.FRAME_PATTERN)),
+                '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-threads', '1',
+                '-f', 'mp4', str(temp_path)
+            ]
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await process.communicate()
+            if process.returncode == 0:
+                os.replace(temp_path, output)
+                return output
+            self.logger.warning(f"ffmpeg 合成失败: {stderr.decode('utf-8', 'ignore')[-500:]}")
+
+        output = self.timelapse_path.joinpath(f"{session.session_id}.jpg")
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, build_contact_sheet, session.get_frame_paths(), output)
+        return output
+
+    def _prune_timelapse(self):
+        """只保留最近的 timelapse_keep 个合成结果，并删除已结束任务遗留的帧（在执行器线程中调用）"""
+        active = self.timelapse_session.path if self.timelapse_session else None
+        artifacts = []
+        for entry in os.scandir(self.timelapse_path):
+            if entry.is_dir():
+                if entry.name.endswith('.frames') and entry.path != str(active):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.endswith(('.mp4', '.jpg')):
+                artifacts.append((entry.stat().st_mtime, entry.path))
+        artifacts.sort(reverse=True)
+        for _, path in artifacts[self.timelapse_keep:]:
+            os.remove(path)
+
+    def _find_timelapse(self, params: Dict[str, Any]) -> Optional[pathlib.Path]:
+        """按 fileName 或 jobUuid 查找合成结果"""
+        names = []
+        if params.get('fileName'):
+            names.append(pathlib.Path(params['fileName']).name)
+        if params.get('jobUuid'):
+            names += [f"{params['jobUuid']}.mp4", f"{params['jobUuid']}.jpg"]
+        for name in names:
+            path = self.timelapse_path.joinpath(name)
+            if path.is_file():
+                return path
+        return None
+
+    async def publish_timelapse(self, path: pathlib.Path, job_uuid: str, **extra):
+        """发布合成结果的链接，并按 timelapse_chunk_kb 分块发送文件内容"""
+        loop = asyncio.get_event_loop()
+        size = path.stat().st_size
+        file_hash = await loop.run_in_executor(None, compute_file_hash, path)
+        chunk_size = self.timelapse_chunk_size
+        chunks = math.ceil(size / chunk_size) if chunk_size > 0 else 0
+        relative_path = path.relative_to(self.gcodes_path).as_posix()
+        params = {
+            "status": "success",
+            "jobUuid": job_uuid,
+            "type": "video" if path.suffix == '.mp4' else "image",
+            "fileName": path.name,
+            "size": size,
+            "sha256": file_hash,
+            "url": f"/server/files/gcodes/{urllib.parse.quote(relative_path)}",
+            "chunks": chunks
+        }
+        params.update(extra)
+        self.publish_envelope(MQTTConfig.TOPICS['response'], MQTTConfig.METHODS['timelapse_ready'], params)
+
+        if not chunks:
+            return
+        with path.open('rb') as artifact:
+            for index in range(chunks):
+                chunk = await loop.run_in_executor(None, artifact.read, chunk_size)
+                self.publish_envelope(
+                    MQTTConfig.TOPICS['response'],
+                    MQTTConfig.METHODS['timelapse_chunk'],
+                    {
+                        "jobUuid": job_uuid,
+                        "fileName": path.name,
+                        "index": index,
+                        "total": chunks,
+                        "data": base64.b64encode(chunk).decode('utf-8')
+                    }
+                )
+                await asyncio.sleep(self.timelapse_chunk_interval)
+
+    async def handle_timelapse_get(self, payload: Dict[str, Any]):
+        """重新发送已合成的延时摄影"""
+        method = MQTTConfig.METHODS['timelapse_ready']
+        params = payload.get('params') or {}
+        try:
+            path = self._find_timelapse(params)
+            if path is None:
+                self._send_files_response(method, params, {"status": "error", "message": "未找到延时摄影"})
+                return
+            extra = {"requestId": params['requestId']} if params.get('requestId') else {}
+            job_uuid = params.get('jobUuid') or path.stem
+            await self.publish_timelapse(path, job_uuid, **extra)
+        except Exception as e:
+            error_msg = f"发送延时摄影失败: {str(e)}"
+            self.logger.error(error_msg)
+            self._send_files_response(method, params, {"status": "error", "message": error_msg})
 
     async def check_status_updates(self):
         """检查状态更新"""
@@ -644,6 +2565,17 @@ class MQTTListener:
                     await self.get_printer_status()
                 else:
                     self.logger.info("未到更新时间")
+
+                # 状态通知停止时仍按间隔取帧
+                self.update_timelapse()
+
+                # 合并发布未立即发送的变化，长时间无变化时重发心跳
+                self.flush_status(force=current_time - self.last_status_publish > self.status_heartbeat)
+
+                # 定期检查磁盘空间
+                if current_time - self.last_cleanup_check > self.cleanup_interval:
+                    self.last_cleanup_check = current_time
+                    await self.run_disk_cleanup()
                     
             except Exception as e:
                 self.logger.error(f"状态更新检查失败: {str(e)}")
@@ -653,20 +2585,19 @@ class MQTTListener:
             # self.logger.info("等待300秒后进行下一次检查...")
             await asyncio.sleep(2)
 
-    async def get_printer_status(self) -> Dict[str, Any]:
-        """获取打印机状态"""
+    async def get_printer_status(self, subscribe: bool = False) -> Dict[str, Any]:
+        """获取打印机状态，subscribe 为 True 时同时订阅后续变化"""
         try:
             # self.logger.info("正在获取打印机状态...")
             
-            # 构造查询请求
+            # 构造查询请求，对象列表来自状态模型
+            objects = self.status_model.get_query_objects()
+            objects.pop('progress', None)
             request = {
                 "jsonrpc": "2.0",
-                "method": "printer.objects.query",
+                "method": "printer.objects.subscribe" if subscribe else "printer.objects.query",
                 "params": {
-                    "objects": {
-                        "webhooks": None,
-                        "print_stats": ["state", "filename"]
-                    }
+                    "objects": objects
                 },
                 "id": time.time()
             }
@@ -674,7 +2605,7 @@ class MQTTListener:
             # 发送请求并等待响应
             if self.ws_client:
                 # self.logger.info("发送状态查询请求...")
-                await self.ws_client.write_message(json.dumps(request))
+                await self.ws_client.write_message(self.codec.dumps(request))
             else:
                 self.logger.error("WebSocket 客户端未连接")
                 
@@ -689,3 +2620,173 @@ class MQTTListener:
 
 def load_component(config):
     return MQTTListener(config)
+
+
+# ---------------------------------------------------------------------------
+# 传输子进程
+#
+# 启用 transfer_worker 时，下载、哈希、元数据解析、上传和图片编码都在独立进程中
+# 执行，与 Moonraker 之间通过标准输入输出交换 JSON 行消息。
+# ---------------------------------------------------------------------------
+
+WORKER_CHUNK_SIZE = 64 * 1024
+WORKER_PROGRESS_INTERVAL = 0.5
+
+def _worker_throttle(bucket: TokenBucket, size: int):
+    wait = bucket.reserve(size)
+    if wait > 0:
+        time.sleep(wait)
+
+def worker_download(job: Dict[str, Any], emit: Callable, buckets: Dict[str, TokenBucket],
+                    cancelled: threading.Event) -> Dict[str, Any]:
+    """下载到临时文件，同时计算哈希、解析元数据和建立层索引"""
+    path = pathlib.Path(job['path'])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    metadata_parser = GcodeMetadataParser()
+    layer_builder = LayerIndexBuilder()
+    sha256 = hashlib.sha256()
+    with urllib.request.urlopen(urllib.request.Request(job['url'])) as response, path.open('wb') as target:
+        total_size = int(response.headers.get('content-length', 0) or 0)
+        etag = parse_etag(response.headers)
+        expected_hash, use_md5 = resolve_expected_hash(job.get('expected_sha256'), etag)
+        md5 = hashlib.md5() if use_md5 else None
+        downloaded_size = 0
+        reported_size = 0
+        last_report = time.monotonic()
+        while True:
+            if cancelled.is_set():
+                raise RuntimeError("传输已取消")
+            chunk = response.read(WORKER_CHUNK_SIZE)
+            if not chunk:
+                break
+            _worker_throttle(buckets['download'], len(chunk))
+            _worker_throttle(buckets['disk_write'], len(chunk))
+            target.write(chunk)
+            metadata_parser.feed(chunk)
+            layer_builder.feed(chunk)
+            sha256.update(chunk)
+            if md5:
+                md5.update(chunk)
+            downloaded_size += len(chunk)
+
+            now = time.monotonic()
+            if now - last_report >= WORKER_PROGRESS_INTERVAL:
+                emit({'event': 'progress', 'downloaded': downloaded_size, 'total': total_size,
+                      'delta': downloaded_size - reported_size})
+                reported_size = downloaded_size
+                last_report = now
+
+    emit({'event': 'progress', 'downloaded': downloaded_size, 'total': total_size,
+          'delta': downloaded_size - reported_size})
+    file_hash = sha256.hexdigest()
+    verify_download(total_size, downloaded_size, file_hash, expected_hash,
+                    md5.hexdigest() if md5 else None, etag)
+    metadata = metadata_parser.finish()
+    try:
+        layer_builder.finish(metadata.get('estimated_time')).save(pathlib.Path(job['index_path']))
+    except OSError:
+        # 层索引只是缓存，主进程打印时会重新建立
+        pass
+    return {'size': downloaded_size, 'sha256': file_hash, 'metadata': metadata}
+
+def worker_upload(job: Dict[str, Any], emit: Callable, buckets: Dict[str, TokenBucket],
+                  cancelled: threading.Event) -> Dict[str, Any]:
+    """从本地文件流式上传到 Moonraker"""
+    path = pathlib.Path(job['path'])
+    file_size = path.stat().st_size
+    head, tail, content_type = build_multipart_head(job['filename'], job['print'])
+
+    def iter_body():
+        yield head
+        unreported = 0
+        last_report = time.monotonic()
+        with path.open('rb') as source:
+            while True:
+                if cancelled.is_set():
+                    raise RuntimeError("传输已取消")
+                chunk = source.read(WORKER_CHUNK_SIZE)
+                if not chunk:
+                    break
+                _worker_throttle(buckets['disk_write'], len(chunk))
+                unreported += len(chunk)
+                now = time.monotonic()
+                if now - last_report >= WORKER_PROGRESS_INTERVAL:
+                    emit({'event': 'progress', 'delta': unreported})
+                    unreported = 0
+                    last_report = now
+                yield chunk
+        if unreported:
+            emit({'event': 'progress', 'delta': unreported})
+        yield tail
+
+    req = urllib.request.Request(
+        job['url'],
+        data=iter_body(),
+        headers={
+            'Content-Type': content_type,
+            'Content-Length': str(len(head) + file_size + len(tail))
+        },
+        method='POST'
+    )
+    with urllib.request.urlopen(req) as response:
+        response.read()
+    return {'size': file_size}
+
+def worker_snapshot(job: Dict[str, Any], emit: Callable, buckets: Dict[str, TokenBucket],
+                    cancelled: threading.Event) -> Dict[str, Any]:
+    """获取摄像头快照，指定 path 时写入文件，否则编码为 base64"""
+    if job.get('path'):
+        return {'size': save_snapshot(job['url'], pathlib.Path(job['path']))}
+    with urllib.request.urlopen(job['url']) as response:
+        image = response.read()
+    return {'data': base64.b64encode(image).decode('utf-8')}
+
+def run_transfer_worker():
+    """子进程入口：从标准输入读取任务，向标准输出写入事件"""
+    output_lock = threading.Lock()
+    buckets = {'download': TokenBucket(), 'disk_write': TokenBucket()}
+    cancel_events: Dict[int, threading.Event] = {}
+    handlers = {
+        'download': worker_download,
+        'upload': worker_upload,
+        'snapshot': worker_snapshot,
+    }
+
+    def emit(job_id: int, event: Dict[str, Any]):
+        event['id'] = job_id
+        line = json.dumps(event, ensure_ascii=False) + '\n'
+        with output_lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+    def run(job: Dict[str, Any]):
+        job_id = job['id']
+        try:
+            result = handlers[job['op']](job, lambda event: emit(job_id, event), buckets, cancel_events[job_id])
+            emit(job_id, {'event': 'done', 'result': result})
+        except Exception as e:
+            emit(job_id, {'event': 'error', 'message': str(e)})
+        finally:
+            cancel_events.pop(job_id, None)
+
+    # 父进程关闭管道时退出
+    for line in sys.stdin:
+        try:
+            job = json.loads(line)
+        except ValueError:
+            continue
+        op = job.get('op')
+        if op == 'limits':
+            buckets['download'].set_rate(job['download'])
+            buckets['disk_write'].set_rate(job['disk_write'])
+        elif op == 'cancel':
+            event = cancel_events.get(job.get('target'))
+            if event:
+                event.set()
+        elif op in handlers:
+            cancel_events[job['id']] = threading.Event()
+            threading.Thread(target=run, args=(job,), daemon=True).start()
+
+
+if __name__ == "__main__" and "--transfer-worker" in sys.argv:
+    run_transfer_worker()
@@ -9,6 +9,12 @@ import socket
 import os
 import subprocess
 import asyncio
+import sys
+import io
+import time
+import base64
+import hashlib
+from typing import Optional
 
 # 配置日志
 log_path = pathlib.Path.home().joinpath("printer_data/logs")
@@ -24,6 +30,13 @@ class Server:
         self.c3p_registration_url = "http://35.183.199.58:1000/c3p/device/registration"
         self.controller_software_version = 'v0.0.1'
         self.data_path = pathlib.Path(data_path).expanduser().resolve()
+        # 注册状态缓存，用于判断是否需要重新注册
+        self.registration_state_path = self.data_path.joinpath("c3p/registration.json")
+        self.token_renew_margin = 24 * 3600
+        # 无法解析过期时间的 token 按注册时间计算最长使用期限
+        self.token_max_age = 7 * 24 * 3600
+        self.auth_token = ""
+        self.access_code = ""
         self.get_controller_info()
 
     def get_local_ip4(self) -> str:
@@ -91,11 +104,77 @@ class Server:
             "controller_software_version": self.controller_software_version
         }
 
-    def register_controller(self):
-        headers = self.get_request_headers()
-        message = json.dumps(self.build_registration_request())
-        self.send_registration_request(headers, message)
-        self.create_mqtt_config()
+    def register_controller(self, reconcile: bool = False) -> bool:
+        """注册控制器并生成 MQTT 配置，返回配置文件是否发生变化"""
+        if reconcile and self.restore_registration():
+            logging.info("注册信息未变化且 token 仍有效，跳过重新注册。")
+        else:
+            headers = self.get_request_headers()
+            message = json.dumps(self.build_registration_request())
+            self.send_registration_request(headers, message)
+            self.save_registration_state()
+        return self.create_mqtt_config()
+
+    def get_registration_fingerprint(self) -> str:
+        """根据设备的稳定信息计算注册指纹（不含 IP、剩余空间等易变字段）"""
+        identity = {
+            "registration_url": self.c3p_registration_url,
+            "mac_address": self.mac_address,
+            "device_internal_uuid": self.device_internal_uuid,
+            "hostname": self.hostname,
+            "model": self.model,
+            "total_storage": self.total_storage,
+            "controller_software_version": self.controller_software_version
+        }
+        encoded = json.dumps(identity, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get_token_expiry(self, token: str) -> Optional[float]:
+        """解析 JWT 中的 exp 字段，无法解析时返回 None"""
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            claims = json.loads(base64.urlsafe_b64decode(payload).decode('utf-8'))
+            return float(claims['exp'])
+        except Exception:
+            return None
+
+    def load_registration_state(self) -> dict:
+        try:
+            with self.registration_state_path.open('r') as state_file:
+                return json.load(state_file)
+        except Exception:
+            return {}
+
+    def save_registration_state(self):
+        state = {
+            "fingerprint": self.get_registration_fingerprint(),
+            "jwtToken": self.auth_token,
+            "accessCode": self.access_code,
+            "registered_at": int(time.time())
+        }
+        self.registration_state_path.parent.mkdir(parents=True, exist_ok=True)
+        # 创建时即限制为仅当前用户可读写，已存在的文件同样收紧权限
+        fd = os.open(self.registration_state_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as state_file:
+            json.dump(state, state_file)
+
+    def restore_registration(self) -> bool:
+        """指纹一致且 token 未过期时复用上次的注册结果"""
+        state = self.load_registration_state()
+        token = state.get("jwtToken", "")
+        if not token or state.get("fingerprint") != self.get_registration_fingerprint():
+            return False
+        expiry = self.get_token_expiry(token)
+        if expiry is None:
+            expiry = state.get("registered_at", 0) + self.token_max_age
+        if expiry - time.time() < self.token_renew_margin:
+            logging.info("token 即将过期，需要重新注册。")
+            return False
+        self.auth_token = token
+        self.access_code = state.get("accessCode", "")
+        return True
 
     def get_request_headers(self):
         return {
@@ -115,7 +194,8 @@ class Server:
             self.auth_token = auth_params.get("jwtToken", "")
             self.access_code = auth_params.get("accessCode", "")
 
-    def create_mqtt_config(self):
+    def create_mqtt_config(self) -> bool:
+        """生成 c3p-mqtt.cfg，仅在内容变化时写入，返回是否有变化"""
         config = configparser.ConfigParser()
         self.setup_mqtt_config(config)
         mqtt_config_path = self.data_path.joinpath("config/c3p-mqtt.cfg")
@@ -123,19 +203,26 @@ class Server:
 
         try:
             # 写入配置文件
-            self.write_config_to_file(config, mqtt_config_path)
-            logging.info("c3p_mqtt.cfg 文件已成功生成。")
-            
+            config_changed = self.write_config_to_file(config, mqtt_config_path)
+            if config_changed:
+                logging.info("c3p_mqtt.cfg 文件已成功生成。")
+            else:
+                logging.info("c3p_mqtt.cfg 内容未变化，未执行写入。")
+
             # 追加到 moonraker 配置
-            self.append_to_moonraker_config()
-            
-            # 这里重启服务
+            include_changed = self.append_to_moonraker_config()
+            return config_changed or include_changed
+
+        except Exception as e:
+            logging.error(f"生成配置文件时出错: {e}")
+            return False
+
+    def restart_moonraker(self):
+        try:
             subprocess.run(["systemctl", "restart", "moonraker"], check=True)
             logging.info("Moonraker 服务已成功重启。")
-            
         except Exception as e:
-            logging.error(f"生成配置文件或重启服务时出错: {e}")
-            # 这里可以选择抛出异常或进行其他处理
+            logging.error(f"重启 Moonraker 服务时出错: {e}")
 
     def setup_mqtt_config(self, config):
         # 添加 update_manager 配置段
@@ -176,11 +263,23 @@ class Server:
         config.set('mqtt', 'access_code', self.access_code)
         config.add_section('mqtt_listener')
 
-    def write_config_to_file(self, config, path):
-        with path.open('w') as configfile:
-            config.write(configfile)
+    def write_config_to_file(self, config, path) -> bool:
+        buffer = io.StringIO()
+        config.write(buffer)
+        return self.write_if_changed(path, buffer.getvalue())
 
-    def append_to_moonraker_config(self):
+    def write_if_changed(self, path, content: str) -> bool:
+        """仅在磁盘内容与期望内容不一致时写入"""
+        try:
+            if path.read_text() == content:
+                return False
+        except (FileNotFoundError, UnicodeDecodeError):
+            pass
+        with path.open('w') as target_file:
+            target_file.write(content)
+        return True
+
+    def append_to_moonraker_config(self) -> bool:
         self.moonraker_path = self.data_path.joinpath("config/moonraker.conf")
         with self.moonraker_path.open('a+') as moonraker_file:
             moonraker_file.seek(0)
@@ -188,10 +287,11 @@ class Server:
             if "[include c3p-mqtt.cfg]" not in content:
                 moonraker_file.write("\n[include c3p-mqtt.cfg]\n")
                 logging.info("已添加 [include c3p-mqtt.cfg] 到 moonraker.conf。")
-            else:
-                logging.info("[include c3p-mqtt.cfg] 已存在，未执行任何操作。")
+                return True
+            logging.info("[include c3p-mqtt.cfg] 已存在，未执行任何操作。")
+            return False
 
-    def write_mqtt_listener_config(self):
+    def write_mqtt_listener_config(self) -> bool:
         mqtt_listener_path = pathlib.Path(__file__).parent.joinpath("mqtt_listener.py")
         components_path = pathlib.Path.home().joinpath("moonraker/moonraker/components")
         components_path.mkdir(parents=True, exist_ok=True)
@@ -200,15 +300,26 @@ class Server:
         with mqtt_listener_path.open('r') as source_file:
             config_content = source_file.read()
 
-        with config_file_path.open('w') as configfile:
-            configfile.write(config_content)
+        if not self.write_if_changed(config_file_path, config_content):
+            logging.info("mqtt_listener.py 未变化，未执行写入。")
+            return False
         logging.info("mqtt_listener.py 配置文件已成功写入到 ~/moonraker/moonraker/components/ 文件夹中。")
+        return True
 
-def main():
+def main(argv: Optional[list] = None):
+    # 默认以 reconcile 模式运行：只有配置或组件实际变化时才重启 Moonraker
+    # 使用 --force 强制重新注册、重写配置并重启
+    if argv is None:
+        argv = sys.argv[1:]
+    reconcile = "--force" not in argv
     data_path = "~/printer_data"
     server = Server(data_path)
-    server.write_mqtt_listener_config()
-    server.register_controller()
+    listener_changed = server.write_mqtt_listener_config()
+    config_changed = server.register_controller(reconcile)
+    if not reconcile or listener_changed or config_changed:
+        server.restart_moonraker()
+    else:
+        logging.info("配置与组件均未变化，跳过重启 Moonraker。")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+
+from mqtt_listener import CommandDispatcher, MQTTConfig
+
+
+def make_dispatcher(max_running=8):
+    rejected = []
+    dispatcher = CommandDispatcher(
+        logging.getLogger('test'),
+        lambda method, data, reason: rejected.append((method, reason)),
+        max_running=max_running
+    )
+    return dispatcher, rejected
+
+
+def test_priority_order_within_global_limit():
+    async def run():
+        dispatcher, _ = make_dispatcher(max_running=1)
+        order = []
+        release = asyncio.Event()
+
+        async def blocker(data):
+            await release.wait()
+
+        async def record(data):
+            order.append(data['name'])
+
+        dispatcher.register('block', blocker, priority=MQTTConfig.PRIORITY_BULK)
+        dispatcher.register('bulk', record, priority=MQTTConfig.PRIORITY_BULK)
+        dispatcher.register('snapshot', record, priority=MQTTConfig.PRIORITY_SNAPSHOT)
+        dispatcher.submit('block', {})
+        dispatcher.submit('bulk', {'name': 'bulk'})
+        dispatcher.submit('snapshot', {'name': 'snapshot'})
+        release.set()
+        await asyncio.sleep(0.05)
+        return order
+
+    assert asyncio.run(run()) == ['snapshot', 'bulk']
+
+
+def test_control_commands_bypass_global_limit():
+    async def run():
+        dispatcher, _ = make_dispatcher(max_running=1)
+        release = asyncio.Event()
+        done = []
+
+        async def blocker(data):
+            await release.wait()
+
+        async def control(data):
+            done.append(True)
+
+        dispatcher.register('block', blocker, priority=MQTTConfig.PRIORITY_BULK)
+        dispatcher.register('control', control, priority=MQTTConfig.PRIORITY_CONTROL)
+        dispatcher.submit('block', {})
+        dispatcher.submit('control', {})
+        await asyncio.sleep(0.05)
+        release.set()
+        return done
+
+    assert asyncio.run(run()) == [True]
+
+
+def test_full_queue_is_rejected_as_busy():
+    async def run():
+        dispatcher, rejected = make_dispatcher()
+        release = asyncio.Event()
+
+        async def blocker(data):
+            await release.wait()
+
+        dispatcher.register('slow', blocker, max_concurrency=1, max_queue=1)
+        results = [dispatcher.submit('slow', {}) for _ in range(3)]
+        release.set()
+        await asyncio.sleep(0.05)
+        return results, rejected
+
+    results, rejected = asyncio.run(run())
+    assert results == [True, True, False]
+    assert rejected == [('slow', 'busy')]
+
+
+def test_expired_command_is_dropped():
+    async def run():
+        dispatcher, rejected = make_dispatcher()
+        handled = []
+
+        async def handler(data):
+            handled.append(data)
+
+        dispatcher.register('cmd', handler)
+        dispatcher.submit('cmd', {'deadline': time.time() - 1})
+        await asyncio.sleep(0.05)
+        return handled, rejected, dispatcher.get_stats()
+
+    handled, rejected, stats = asyncio.run(run())
+    assert handled == []
+    assert rejected == [('cmd', 'expired')]
+    assert stats['queued'] == {'cmd': 0}
+
+
+def test_ignored_and_unknown_methods():
+    dispatcher, rejected = make_dispatcher()
+    dispatcher.register('ignored', None)
+
+    assert dispatcher.submit('ignored', {}) is True
+    assert dispatcher.submit('unknown', {}) is False
+    assert rejected == []
@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+import pytest
+
+from mqtt_listener import (
+    MQTTListener, parse_etag, parse_managed_file_name, resolve_expected_hash, verify_download
+)
+
+CONTENT = b'G1 X1\n' * 100
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+MD5 = hashlib.md5(CONTENT).hexdigest()
+
+
+def test_parse_etag_strips_weak_prefix_and_quotes():
+    assert parse_etag({'etag': 'W/"ABCDEF"'}) == 'abcdef'
+    assert parse_etag({}) == ''
+
+
+def test_md5_etag_is_verified():
+    expected, use_md5 = resolve_expected_hash(None, MD5)
+    assert expected is None and use_md5
+
+    verify_download(len(CONTENT), len(CONTENT), SHA256, expected, MD5, MD5)
+    with pytest.raises(ValueError):
+        verify_download(len(CONTENT), len(CONTENT), SHA256, expected, '0' * 32, MD5)
+
+
+def test_multipart_etag_is_not_treated_as_md5():
+    etag = parse_etag({'etag': f'"{MD5}-3"'})
+    expected, use_md5 = resolve_expected_hash(None, etag)
+
+    assert expected is None and not use_md5
+    verify_download(len(CONTENT), len(CONTENT), SHA256, expected, None, etag)
+
+
+def test_sha256_etag_and_explicit_hash_take_precedence():
+    assert resolve_expected_hash(None, SHA256) == (SHA256, False)
+    assert resolve_expected_hash(SHA256, MD5) == (SHA256, False)
+
+
+def test_size_mismatch_rejected():
+    with pytest.raises(ValueError, match='不完整'):
+        verify_download(len(CONTENT), len(CONTENT) - 1, SHA256, None, None, '')
+    # 没有 content-length 时不校验大小
+    verify_download(0, len(CONTENT), SHA256, None, None, '')
+
+
+def test_sha256_mismatch_rejected():
+    with pytest.raises(ValueError, match='SHA-256'):
+        verify_download(len(CONTENT), len(CONTENT), SHA256, '0' * 64, None, '')
+
+
+def test_managed_file_name_fields():
+    assert parse_managed_file_name('part-@-job-@-key.gcode') == ('part', 'job', 'key')
+    assert parse_managed_file_name('part-@-job.gcode') is None
+    assert parse_managed_file_name('part-@-job-@-key.txt') is None
+
+
+@pytest.fixture
+def listener(tmp_path):
+    listener = MQTTListener.__new__(MQTTListener)
+    listener.logger = logging.getLogger('test')
+    listener.gcodes_path = tmp_path
+    listener.file_cache_path = tmp_path / '.c3p'
+    return listener
+
+
+def add_file(listener, filename, content=CONTENT, cached_hash=None):
+    listener.gcodes_path.joinpath(filename).write_bytes(content)
+    if cached_hash:
+        listener.save_file_cache(filename, {'sha256': cached_hash})
+    return {'filename': filename}
+
+
+def find(listener, files, file_key, expected_hash):
+    return asyncio.run(listener.find_reusable_file(files, file_key, expected_hash))
+
+
+def test_reuse_by_cached_hash_under_other_file_key(listener):
+    files = [
+        add_file(listener, 'a-@-job1-@-key1.gcode', b'other', hashlib.sha256(b'other').hexdigest()),
+        add_file(listener, 'b-@-job2-@-key2.gcode', cached_hash=SHA256),
+    ]
+
+    assert find(listener, files, 'key3', SHA256) == 'b-@-job2-@-key2.gcode'
+
+
+def test_reuse_matches_file_key_field_not_job(listener):
+    files = [add_file(listener, 'a-@-key1-@-other.gcode'), add_file(listener, 'b-@-job-@-key1.gcode')]
+
+    assert find(listener, files, 'key1', None) == 'b-@-job-@-key1.gcode'
+
+
+def test_file_key_match_with_wrong_hash_redownloads(listener):
+    files = [add_file(listener, 'a-@-job-@-key1.gcode', b'stale contents')]
+
+    assert find(listener, files, 'key1', SHA256) is None
+    # 旧文件的哈希被计算并缓存
+    cache = json.loads(listener.file_cache_path.joinpath('a-@-job-@-key1.gcode.json').read_text())
+    assert cache['sha256'] == hashlib.sha256(b'stale contents').hexdigest()
+
+
+def test_file_key_match_with_hash_verified_legacy_file(listener):
+    files = [add_file(listener, 'a-@-job-@-key1.gcode')]
+
+    assert find(listener, files, 'key1', SHA256) == 'a-@-job-@-key1.gcode'
@@ -0,0 +1,81 @@
+import pytest
+
+from mqtt_listener import GcodeMetadataParser, LayerIndex, LayerIndexBuilder
+
+
+def feed_chunks(parser, data: bytes, chunk_size: int):
+    for start in range(0, len(data), chunk_size):
+        parser.feed(data[start:start + chunk_size])
+    return parser.finish()
+
+
+def test_layer_marker_near_chunk_boundary_counted_once():
+    # 第二个标记位于 8192 字节分块末尾前 10 字节
+    first = b';LAYER:0\nG1 X1\n'
+    second = b'\n;LAYER:1\n'
+    padding = b'G1 X2\n' * ((8192 - 10 - len(first)) // 6)
+    padding += b';' * (8192 - 10 - len(first) - len(padding))
+    data = first + padding + second + b'G1 X3\n' * 100
+    assert data.index(second) + len(second) == 8192
+
+    assert feed_chunks(GcodeMetadataParser(), data, 8192)['layer_count'] == 2
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 13, 64, 8192, 64 * 1024])
+def test_layer_count_independent_of_chunk_size(chunk_size):
+    data = b';LAYER_CHANGE\nG1 X1\n' * 2000 + b';LAYER:2000\nG1 X2\n'
+
+    assert feed_chunks(GcodeMetadataParser(), data, chunk_size)['layer_count'] == 2001
+
+
+def test_metadata_from_head_and_tail():
+    head = (
+        b'; generated by PrusaSlicer 2.7.1\n'
+        b'; thumbnail begin 16x16 8\n; aGVsbG8=\n; thumbnail end\n'
+    )
+    body = b'G1 X1\n' * 300000
+    tail = (
+        b'; estimated printing time (normal mode) = 1h 2m 3s\n'
+        b'; filament used [mm] = 1234.5\n'
+        b'; layer_height = 0.2\n'
+    )
+    metadata = feed_chunks(GcodeMetadataParser(), head + body + tail, 8192)
+
+    assert metadata['slicer'] == 'PrusaSlicer'
+    assert metadata['slicer_version'] == '2.7.1'
+    assert metadata['estimated_time'] == 3723.0
+    assert metadata['filament_total'] == 1234.5
+    assert metadata['layer_height'] == 0.2
+    assert metadata['thumbnail']['data'] == 'aGVsbG8='
+    assert metadata['size'] == len(head + body + tail)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 8192])
+def test_layer_index_offsets_across_chunks(chunk_size):
+    layer = b';LAYER_CHANGE\n;TIME_ELAPSED:%d\nG1 X1\n'
+    data = b';LAYER_CHANGE\nG1 X0\n' + b''.join(layer % (i * 10) for i in range(1, 5))
+    builder = LayerIndexBuilder()
+    for start in range(0, len(data), chunk_size):
+        builder.feed(data[start:start + chunk_size])
+    index = builder.finish(50.0)
+
+    expected = [i for i in range(len(data)) if data.startswith(b';LAYER_CHANGE', i)]
+    assert list(index.offsets) == expected
+    assert index.lookup(0)['total_layers'] == 5
+    assert index.lookup(expected[2])['current_layer'] == 3
+
+
+def test_layer_index_save_and_load(tmp_path):
+    data = b''.join(b';LAYER:%d\nM73 R%d\nG1 X1\n' % (i, 10 - i) for i in range(10))
+    builder = LayerIndexBuilder()
+    builder.feed(data)
+    index = builder.finish(600.0)
+    path = tmp_path / 'index.layers'
+    index.save(path)
+
+    loaded = LayerIndex.load(path)
+    assert list(loaded.offsets) == list(index.offsets)
+    assert list(loaded.times) == list(index.times)
+    assert loaded.file_size == len(data)
+    assert loaded.lookup(len(data)) == index.lookup(len(data))
+    assert LayerIndex.load(tmp_path / 'missing.layers') is None
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+
+from mqtt_listener import LayerIndexBuilder, MQTTConfig, MQTTListener, StatusModel
+
+
+def build_index(data: bytes, estimated_time=None):
+    builder = LayerIndexBuilder()
+    builder.feed(data)
+    return builder.finish(estimated_time)
+
+
+def test_progress_without_time_data_is_byte_linear():
+    data = b''.join(b';LAYER:%d\nG1 X1 Y1\n' % i for i in range(10))
+    index = build_index(data)
+
+    assert index.total_time == 0
+    assert index.lookup(0)['progress'] == 0.0
+    middle = index.lookup(len(data) // 2)
+    assert middle['progress'] == 50.0
+    assert middle['current_layer'] == 6
+    assert middle['eta'] is None
+    assert index.lookup(len(data))['progress'] == 100.0
+
+
+def test_progress_with_estimated_time():
+    data = b''.join(b';LAYER:%d\nG1 X1 Y1\n' % i for i in range(10))
+    result = build_index(data, estimated_time=1000.0).lookup(len(data) // 2)
+
+    assert result['progress'] == 50.0
+    assert result['eta'] == 500
+    assert set(result) == set(MQTTConfig.PROGRESS_FIELDS)
+
+
+def make_listener(index):
+    listener = MQTTListener.__new__(MQTTListener)
+    listener.logger = logging.getLogger('test')
+    listener.status_model = StatusModel({'progress': list(MQTTConfig.PROGRESS_FIELDS)})
+    listener.current_print_file = 'first.gcode'
+    listener.layer_index_file = 'first.gcode'
+    listener.layer_index = index
+
+    async def load_layer_index(file_name):
+        pass
+
+    listener.load_layer_index = load_layer_index
+    return listener
+
+
+def test_progress_cleared_when_print_file_changes():
+    data = b''.join(b';LAYER:%d\nG1 X1 Y1\n' % i for i in range(10))
+    listener = make_listener(build_index(data, estimated_time=1000.0))
+    model = listener.status_model
+
+    async def run():
+        model.update({'progress': listener.get_print_progress(len(data) // 2)})
+        assert model.get('progress', 'current_layer') == 6
+        assert model.get('progress', 'eta') == 500
+
+        listener.current_print_file = 'second.gcode'
+        assert listener.get_print_progress(100) is None
+
+    asyncio.run(run())
+    assert all(model.get('progress', field) is None for field in MQTTConfig.PROGRESS_FIELDS)
+    assert 'progress' not in model.to_dict()
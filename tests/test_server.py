@@ -0,0 +1,132 @@
+import base64
+import importlib
+import json
+import os
+import stat
+import time
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def server_module(tmp_path_factory):
+    # server.py 在导入时于 ~/printer_data/logs 下配置日志
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = str(tmp_path_factory.mktemp('home'))
+    try:
+        return importlib.import_module('server')
+    finally:
+        if home is not None:
+            os.environ['HOME'] = home
+
+
+def make_jwt(exp):
+    payload = base64.urlsafe_b64encode(json.dumps({'exp': exp}).encode()).decode().rstrip('=')
+    return f"header.{payload}.signature"
+
+
+class Environment:
+    def __init__(self, module, monkeypatch, tmp_path):
+        self.identity = {
+            'hostname': 'printer',
+            'private_ip4': '192.168.1.2',
+            'public_ip4': '1.2.3.4',
+            'model': '6.1.0',
+            'total_storage': 30000,
+            'remaining_storage': 20000,
+            'mac_address': 'aa:bb:cc:dd:ee:ff',
+            'device_internal_uuid': 'device-uuid',
+        }
+        self.token_expiry = time.time() + 30 * 24 * 3600
+        self.registrations = 0
+        self.issued = 0
+        self.restarts = 0
+        self.listener_changed = False
+        env = self
+
+        def get_controller_info(server):
+            server.__dict__.update(env.identity)
+
+        def send_registration_request(server, headers, message):
+            env.registrations += 1
+            env.issued += 1
+            # 每次注册返回新的 token
+            server.auth_token = make_jwt(env.token_expiry + env.issued)
+            server.access_code = f"code-{env.issued}"
+
+        def restart_moonraker(server):
+            env.restarts += 1
+
+        server_class = module.Server
+        monkeypatch.setenv('HOME', str(tmp_path))
+        monkeypatch.setattr(server_class, 'get_controller_info', get_controller_info)
+        monkeypatch.setattr(server_class, 'send_registration_request', send_registration_request)
+        monkeypatch.setattr(server_class, 'restart_moonraker', restart_moonraker)
+        monkeypatch.setattr(server_class, 'write_mqtt_listener_config', lambda server: env.listener_changed)
+        self.module = module
+        self.state_path = tmp_path / 'printer_data' / 'c3p' / 'registration.json'
+
+    def run(self, *argv):
+        self.registrations = 0
+        self.restarts = 0
+        self.module.main(list(argv))
+        return self.registrations, self.restarts
+
+    def update_state(self, **values):
+        state = json.loads(self.state_path.read_text())
+        state.update(values)
+        self.state_path.write_text(json.dumps(state))
+
+
+@pytest.fixture
+def env(server_module, monkeypatch, tmp_path):
+    environment = Environment(server_module, monkeypatch, tmp_path)
+    environment.run()
+    return environment
+
+
+def test_first_run_registers_and_restarts(env):
+    assert env.registrations == 1
+    assert env.restarts == 1
+    assert stat.S_IMODE(env.state_path.stat().st_mode) == 0o600
+
+
+def test_unchanged_skips_registration_and_restart(env):
+    assert env.run() == (0, 0)
+
+
+def test_volatile_fields_do_not_trigger_registration(env):
+    env.identity['public_ip4'] = '5.6.7.8'
+    env.identity['remaining_storage'] = 100
+
+    assert env.run() == (0, 0)
+
+
+def test_fingerprint_change_reregisters_and_restarts(env):
+    env.identity['hostname'] = 'renamed'
+
+    assert env.run() == (1, 1)
+
+
+def test_token_near_expiry_reregisters(env):
+    env.update_state(jwtToken=make_jwt(time.time() + 3600))
+
+    assert env.run() == (1, 1)
+
+
+def test_opaque_token_renewed_after_max_age(env):
+    env.update_state(jwtToken='opaque-token', registered_at=int(time.time()))
+    assert env.run() == (0, 1)
+
+    env.update_state(registered_at=int(time.time()) - 7 * 24 * 3600)
+    assert env.run() == (1, 1)
+
+
+def test_listener_change_restarts_without_registration(env):
+    env.listener_changed = True
+
+    assert env.run() == (0, 1)
+
+
+def test_force_reregisters_and_restarts(env):
+    assert env.run('--force') == (1, 1)
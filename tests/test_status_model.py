@@ -0,0 +1,60 @@
+from mqtt_listener import StatusModel
+
+
+def make_model():
+    return StatusModel(
+        {
+            'print_stats': ['state', 'filename'],
+            'extruder': ['temperature', 'target'],
+            'fan': None,
+        },
+        urgent_fields=(('print_stats', 'state'),)
+    )
+
+
+def test_query_objects_keep_declared_fields():
+    assert make_model().get_query_objects() == {
+        'print_stats': ['state', 'filename'],
+        'extruder': ['temperature', 'target'],
+        'fan': None,
+    }
+
+
+def test_update_tracks_changes_and_version():
+    model = make_model()
+
+    assert model.update({'extruder': {'temperature': 20.5, 'target': 0.0}}) == 2
+    assert model.version == 1
+    assert model.dirty and not model.has_urgent_changes()
+
+    model.clear_dirty()
+    assert model.update({'extruder': {'temperature': 20.5}}) == 0
+    assert model.version == 1
+    assert not model.dirty
+
+
+def test_unknown_objects_and_fields_are_ignored():
+    model = make_model()
+
+    assert model.update({'heater_bed': {'temperature': 60}, 'extruder': {'power': 0.5}}) == 0
+    assert model.get('extruder', 'power') is None
+    assert model.to_dict() == {}
+
+
+def test_urgent_field_change():
+    model = make_model()
+    model.update({'print_stats': {'state': 'printing'}})
+
+    assert model.has_urgent_changes()
+    model.clear_dirty()
+    model.update({'print_stats': {'filename': 'a.gcode'}})
+    assert not model.has_urgent_changes()
+
+
+def test_whole_object_merges_fields():
+    model = make_model()
+    model.update({'fan': {'speed': 0.5}})
+    model.update({'fan': {'rpm': 1200}})
+
+    assert model.get('fan', StatusModel.WHOLE_OBJECT) == {'speed': 0.5, 'rpm': 1200}
+    assert model.to_dict() == {'fan': {'speed': 0.5, 'rpm': 1200}}